@@ -1,7 +1,15 @@
 import os
 
 CAMERA_RESOLUTION = (640, 480)  # the resolution to use for the raspberry pi camera
+CAMERA_WAIT_FOR_NEW_FRAME = False  # block the camera pipeline until a frame arrives that was not processed yet
+CAMERA_FRAME_TIMEOUT = 500  # max time in ms to wait for a new camera frame
+CAMERA_RING_SIZE = 4  # number of preallocated capture buffers (at least 3)
 SCANLINE_DISTANCE = 5
+ROI_PADDING = 1.0  # padding around the last bbox that is searched in roi mode, relative to the bbox size
+ROI_MIN_SIZE = 64  # minimum width and height of the searched window in roi mode
+USE_ROI_TRACKING = True  # only search around the last detection while following / tracking
+DETECTION_SCALE = 1  # scale the image is downsized to for color detection (e.g. .5 or .25)
+DETECTION_REFINE = False  # refine bboxes found at a lower scale at full resolution
 
 DETECTION_SIZE_THRESHOLD = .001  # minimum size of a colored object, relative to the total image size
 
@@ -12,6 +20,22 @@ GRAPHICAL_OUTPUT = True  # enable or disable graphical output
 TRACKING_ALGORITHM = 'TLD'  # algorithm to use for object tracking in images
 
 USE_TRUE_PARALLEL_PIPELINES = True  # use multithreading in parallel pipelines
+PARALLEL_PIPELINE_WORKERS = 4  # size of the thread pool shared by all parallel pipelines
+PROCESS_BRANCH_TIMEOUT = 1000  # ms to wait for a worker process of a process parallel pipeline before its branch fails
+
+USE_PIPELINE_MEMOIZATION = True  # share results of identical pure pipeline stages within a tick
+MEMO_CACHE_SIZE = 64  # maximum number of memoized stage results
+
+PROFILE_PIPELINES = True  # record execution time histograms of all pipeline stages
+PROFILE_REPORT_INTERVAL = 0  # state machine updates between two logged profile reports (0: never)
+
+ASYNC_CALLBACKS = True  # run AsyncCallbacks (e.g. the graphical output) on a background thread
+
+USE_ASYNCIO = False  # run the sensors and the state machine on an asyncio event loop instead of threads
+SENSOR_IO_WORKERS = 4  # threads for blocking sensor reads (camera capture, ultrasonic echo) in the asyncio runtime
+
+SENSOR_DEADLINE = 100  # ms a state pipeline waits for its camera branch before it goes on with the other sensors
+SENSOR_QUORUM = None  # number of successful sensor branches after which a state pipeline returns (None: no quorum)
 
 USE_USB_CAMERA = False
 # the paths to relevant directories of the project
@@ -23,6 +47,18 @@ PICTUREPATH = os.path.join(ROOT_PATH, "assets", "gestures")
 SOUNDPATH = os.path.join(ROOT_PATH, "assets", "sounds")
 HAARPATH = os.path.join(DATAPATH, "haarcascades")
 
+# STATE MACHINE CONFIG
+
+HISTORY_DEPTH = 100  # number of updates the state machine history keeps
+
+HISTORY_RAW_DEPTH = 1  # number of newest updates whose outputs are kept with (copies of) their images, 0 for none
+
+TICK_BUDGET = None  # ms a state machine update may spend in the state pipeline (None: unlimited)
+
+TICK_RATE = None  # state machine updates per second (None: as fast as possible)
+
+TICK_ON_SENSOR_DATA = False  # only update the state machine when new sensor data arrived (at least at TICK_RATE)
+
 # MOVEMENT CONFIG
 
 STATE_SWITCH_COOLDOWN = 1000
@@ -42,6 +78,7 @@ FORWARD_SPEED_MULT = 1.0
 # Bluetooth Config
 
 BT_TARGET_UUID = "6951e12f049945d2930e1fc462c721c8"  # The uuid of the bt beacon
+BT_BEACON_UUIDS = []  # The uuids of further beacons (e.g. for calibration) every dongle records
 BT_DONGLE_IDS = list(range(2))  # The device ids of the bt dongles to use
 
 # - Configures how the speed is recommended using bluetooth
@@ -57,6 +94,7 @@ BT_DISTANCE_THRESHOLDS = {
 }
 # - Misc
 BT_TIME_THRESHOLD = 1800  # The time in ms from which bt data is collected
+BT_READ_BATCH = 32  # Max number of packets read from a dongle per wakeup
 
 IF_US_START_DELAY = 1000
 
@@ -70,6 +108,10 @@ US_DISTANCE_THRESHOLD = 75
 
 US_DATA_ACC_THRESHOLD = 1000
 
+US_EVENT_DISTANCE = 5  # min change in cm of a measurement that wakes the state machine
+
+US_SAMPLE_INTERVAL = 10  # ms between two measurements in the asyncio runtime
+
 # - Hardware pin config
 
 US_GPIO_TRIGGER = 26
@@ -84,3 +126,7 @@ IR_TIME_THRESHOLD = 500
 IR_DISTANCE_THRESHOLD = 20
 
 IR_DATA_ACC_THRESHOLD = 1000
+
+IR_EVENT_DISTANCE = 5  # min change of a measurement that wakes the state machine
+
+IR_SAMPLE_INTERVAL = 10  # ms between two sensor reads in the asyncio runtime
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import time  # import the time library for the sleep function
 from threading import Thread, Condition, Lock
@@ -17,7 +18,7 @@ class Gesture(Thread):
         "dodge": [0, 1],
     }
 
-    def __init__(self):
+    def __init__(self, start_thread=True):
         Thread.__init__(self)
         self.daemon = True
         self.paused = False
@@ -37,7 +38,9 @@ class Gesture(Thread):
         # show default picture after initialization
         self.screen.change_picture(self.__get_picture("default.gif"))
 
-        self.start()
+        # the asyncio runtime runs produce() instead of the thread
+        if start_thread:
+            self.start()
 
     def __next_picture(self):
         picture_frame = Gesture.PICTURES[self.current_gesture]
@@ -77,6 +80,16 @@ class Gesture(Thread):
 
         print("Gestures stopping")
 
+    async def produce(self):
+        """ The animation loop of run() for the asyncio runtime """
+        while True:
+            if not self.paused and self.current_gesture != "default":
+                picture_path = self.__next_picture()
+                self.current_frame += 1
+                self.screen.change_picture(picture_path)
+
+            await asyncio.sleep(self.picture_delay)
+
     def pause(self):
         self.paused = True
         self.pause_condition.acquire()
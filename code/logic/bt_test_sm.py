@@ -1,5 +1,4 @@
 from logic.statemachine import *
-from utils.functions import current_time_millis
 from sensors.bluetooth import bluetooth, bluetooth_pipelines
 from sensors import pipeline
 from sensors.camera import camera, camera_pipelines
@@ -21,10 +20,21 @@ class BTTestSM(StateMachine):
         logging.debug("Starting BT-Dongles")
         self.bt_dongles = [bluetooth.BTDongle(i, config.BT_TARGET_UUID)
                            for i in config.BT_DONGLE_IDS]
-        for dongle in self.bt_dongles:
-            dongle.start()
+        if not config.USE_ASYNCIO:
+            for dongle in self.bt_dongles:
+                dongle.start()
         self._current_state.first_state = BTTestState(self)
 
+    @overrides(StateMachine)
+    def shutdown(self):
+        for dongle in self.bt_dongles:
+            dongle.stop()
+        bluetooth.REACTOR.stop()
+
+    @overrides(StateMachine)
+    def producers(self):
+        return [dongle.produce() for dongle in self.bt_dongles]
+
 
 class BTTestState(State):
     def __init__(self,state_machine):
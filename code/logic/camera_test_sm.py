@@ -6,6 +6,7 @@ import logging
 from config.config import *
 from logic.statemachine import *
 from sensors.camera import camera, camera_pipelines
+from sensors.pipeline import AsyncCallback, async_result_callback, call_async
 
 
 class CameraTestSM(StateMachine):
@@ -35,6 +36,10 @@ class CameraTestSM(StateMachine):
             logging.warning("Unkown testmode '{}'. Falling back to show-image".format(testmode))
             self._current_state.first_state = ShowImageState()
 
+    @overrides(StateMachine)
+    def producers(self):
+        return [camera.READ_CAMERA_PIPELINE.produce()]
+
 
 class FindLegsState(State):
     def __init__(self):
@@ -43,10 +48,10 @@ class FindLegsState(State):
         self.__pipeline = camera_pipelines.find_legs_pipeline()
 
         if GRAPHICAL_OUTPUT:
-            def show_result(*_):
-                image = self.pipeline["image"].output
-                edges = self.pipeline["edges"].output
-                legs, candidates = self.pipeline["legs"].output
+            def show_result(results):
+                _, image = results["image"]
+                _, edges = results["edges"]
+                legs, candidates = results["legs"][1]
 
                 for leg in candidates:
                     print(leg[0], leg[1])
@@ -59,17 +64,18 @@ class FindLegsState(State):
                 if cv2.waitKey(1) & 0xff == ord('q'):
                     sys.exit()
 
-            self.pipeline.execute_callbacks = [show_result]
+            self.pipeline.execute_callbacks = [async_result_callback(show_result, self.pipeline,
+                                                                     "image", "edges", "legs")]
 
     def on_enter(self):
         if GRAPHICAL_OUTPUT:
-            cv2.namedWindow("camera", cv2.WINDOW_AUTOSIZE)
-            cv2.namedWindow("edges", cv2.WINDOW_AUTOSIZE)
-            cv2.namedWindow("legs", cv2.WINDOW_AUTOSIZE)
+            call_async(cv2.namedWindow, "camera", cv2.WINDOW_AUTOSIZE)
+            call_async(cv2.namedWindow, "edges", cv2.WINDOW_AUTOSIZE)
+            call_async(cv2.namedWindow, "legs", cv2.WINDOW_AUTOSIZE)
 
     def on_exit(self):
         if GRAPHICAL_OUTPUT:
-            cv2.destroyAllWindows()
+            call_async(cv2.destroyAllWindows)
 
     @property
     def pipeline(self):
@@ -86,9 +92,14 @@ class TrackObjectState(State):
         self.__pipeline = camera_pipelines.box_tracking_pipeline(frame, bbox)
 
         if GRAPHICAL_OUTPUT:
-            def show_result(*_):
-                _, _, (bbox_ok, bbox) = self.pipeline[1][0].results
-                _, (image_ok, image), _, (dev_ok, dev) = self.pipeline.results
+            def snapshot(*_):
+                _, _, bbox_result = self.pipeline[1][0].results
+                _, (_, image), _, dev_result = self.pipeline.results
+                return bbox_result, image.copy(), dev_result
+
+            def show_result(bbox_result, image, dev_result):
+                bbox_ok, bbox = bbox_result
+                dev_ok, dev = dev_result
 
                 # draw bounding box
                 if bbox_ok:
@@ -104,15 +115,15 @@ class TrackObjectState(State):
                 if cv2.waitKey(1) & 0xff == ord('q'):
                     sys.exit()
 
-            self.pipeline.execute_callbacks = [show_result]
+            self.pipeline.execute_callbacks = [AsyncCallback(show_result, snapshot)]
 
     def on_enter(self):
         if GRAPHICAL_OUTPUT:
-            cv2.namedWindow('camtest', cv2.WINDOW_AUTOSIZE)
+            call_async(cv2.namedWindow, 'camtest', cv2.WINDOW_AUTOSIZE)
 
     def on_exit(self):
         if GRAPHICAL_OUTPUT:
-            cv2.destroyAllWindows()
+            call_async(cv2.destroyAllWindows)
 
     @property
     def pipeline(self):
@@ -131,9 +142,9 @@ class DetectPersonState(State):
             haarfile=os.path.join(HAARPATH, "lowerbody.xml"))
 
         if GRAPHICAL_OUTPUT:
-            def show_result(*_):
-                bboxes = self.pipeline["cascades"].output
-                image = self.pipeline["image"].output
+            def show_result(results):
+                _, bboxes = results["cascades"]
+                _, image = results["image"]
 
                 # draw bounding box
                 for bbox in bboxes:
@@ -145,15 +156,16 @@ class DetectPersonState(State):
                 if cv2.waitKey(1) & 0xff == ord("q"):
                     sys.exit()
 
-            self.pipeline.execute_callbacks = [show_result]
+            self.pipeline.execute_callbacks = [async_result_callback(show_result, self.pipeline,
+                                                                     "cascades", "image")]
 
     def on_enter(self):
         if GRAPHICAL_OUTPUT:
-            cv2.namedWindow("camtest", cv2.WINDOW_AUTOSIZE)
+            call_async(cv2.namedWindow, "camtest", cv2.WINDOW_AUTOSIZE)
 
     def on_exit(self):
         if GRAPHICAL_OUTPUT:
-            cv2.destroyAllWindows()
+            call_async(cv2.destroyAllWindows)
 
     @property
     def pipeline(self):
@@ -171,10 +183,10 @@ class FindColorStateToTrack(State):
         self.__pipeline = camera_pipelines.color_tracking_pipeline()
 
         if GRAPHICAL_OUTPUT:
-            def show_result(*_):
-                bbox_ok, bbox = self.pipeline["contour_bbox"].result
-                image = self.pipeline["image"].output
-                dev_ok, dev = self.pipeline["y_deviation"].result
+            def show_result(results):
+                bbox_ok, bbox = results["contour_bbox"]
+                _, image = results["image"]
+                dev_ok, dev = results["y_deviation"]
 
                 # draw bounding box
                 if bbox_ok:
@@ -190,15 +202,16 @@ class FindColorStateToTrack(State):
                 if cv2.waitKey(1) & 0xff == ord("q"):
                     sys.exit()
 
-            self.pipeline.execute_callbacks = [show_result]
+            self.pipeline.execute_callbacks = [async_result_callback(show_result, self.pipeline,
+                                                                     "contour_bbox", "image", "y_deviation")]
 
     def on_enter(self):
         if GRAPHICAL_OUTPUT:
-            cv2.namedWindow("camtest", cv2.WINDOW_AUTOSIZE)
+            call_async(cv2.namedWindow, "camtest", cv2.WINDOW_AUTOSIZE)
 
     def on_exit(self):
         if GRAPHICAL_OUTPUT:
-            cv2.destroyAllWindows()
+            call_async(cv2.destroyAllWindows)
 
     @property
     def pipeline(self):
@@ -222,14 +235,14 @@ class ShowColorTrackingPipelineStepsState(State):
         self.__pipeline = camera_pipelines.color_tracking_pipeline()
 
         if GRAPHICAL_OUTPUT:
-            def show_result(*_):
-                bbox_ok, bbox = self.pipeline["contour_bbox"].result
-                image = self.pipeline["image"].output
-                hsv_image = self.pipeline["hsv_image"].output
-                threshold = self.pipeline["threshold"].output
-                filtered = self.pipeline["filtered"].output
-                dev_ok, dev = self.pipeline["y_deviation"].result
-                raw_dev_ok, raw_dev = self.pipeline["raw_y_deviation"].result
+            def show_result(results):
+                bbox_ok, bbox = results["contour_bbox"]
+                _, image = results["image"]
+                _, hsv_image = results["hsv_image"]
+                _, threshold = results["threshold"]
+                _, filtered = results["filtered"]
+                dev_ok, dev = results["y_deviation"]
+                raw_dev_ok, raw_dev = results["raw_y_deviation"]
 
                 # draw bounding box
                 bbox_image = image.copy()
@@ -254,19 +267,21 @@ class ShowColorTrackingPipelineStepsState(State):
                 if cv2.waitKey(1) & 0xff == ord('q'):
                     sys.exit()
 
-            self.pipeline.execute_callbacks = [show_result]
+            self.pipeline.execute_callbacks = [async_result_callback(
+                show_result, self.pipeline, "contour_bbox", "image", "hsv_image", "threshold", "filtered",
+                "y_deviation", "raw_y_deviation")]
 
     def on_enter(self):
         if GRAPHICAL_OUTPUT:
-            cv2.namedWindow("image", cv2.WINDOW_AUTOSIZE)
-            cv2.namedWindow("hsv_image", cv2.WINDOW_AUTOSIZE)
-            cv2.namedWindow("threshold", cv2.WINDOW_AUTOSIZE)
-            cv2.namedWindow("filtered", cv2.WINDOW_AUTOSIZE)
-            cv2.namedWindow("bbox", cv2.WINDOW_AUTOSIZE)
+            call_async(cv2.namedWindow, "image", cv2.WINDOW_AUTOSIZE)
+            call_async(cv2.namedWindow, "hsv_image", cv2.WINDOW_AUTOSIZE)
+            call_async(cv2.namedWindow, "threshold", cv2.WINDOW_AUTOSIZE)
+            call_async(cv2.namedWindow, "filtered", cv2.WINDOW_AUTOSIZE)
+            call_async(cv2.namedWindow, "bbox", cv2.WINDOW_AUTOSIZE)
 
     def on_exit(self):
         if GRAPHICAL_OUTPUT:
-            cv2.destroyAllWindows()
+            call_async(cv2.destroyAllWindows)
 
     @property
     def pipeline(self):
@@ -286,10 +301,10 @@ class FindColorState(State):
         # self.__pipeline = camera_pipelines.fast_color_tracking_pipeline("magenta")
 
         if GRAPHICAL_OUTPUT:
-            def show_result(*_):
-                bbox_ok, bbox = self.pipeline["contour_bbox"].result
-                image = self.pipeline["image"].output
-                dev_ok, dev = self.pipeline["y_deviation"].result
+            def show_result(results):
+                bbox_ok, bbox = results["contour_bbox"]
+                _, image = results["image"]
+                dev_ok, dev = results["y_deviation"]
 
                 # draw bounding box
                 if bbox_ok:
@@ -306,15 +321,16 @@ class FindColorState(State):
                 if cv2.waitKey(1) & 0xff == ord('q'):
                     sys.exit()
 
-            self.pipeline.execute_callbacks = [show_result]
+            self.pipeline.execute_callbacks = [async_result_callback(show_result, self.pipeline,
+                                                                     "contour_bbox", "image", "y_deviation")]
 
     def on_enter(self):
         if GRAPHICAL_OUTPUT:
-            cv2.namedWindow('camtest', cv2.WINDOW_AUTOSIZE)
+            call_async(cv2.namedWindow, 'camtest', cv2.WINDOW_AUTOSIZE)
 
     def on_exit(self):
         if GRAPHICAL_OUTPUT:
-            cv2.destroyAllWindows()
+            call_async(cv2.destroyAllWindows)
 
     @property
     def pipeline(self):
@@ -337,7 +353,7 @@ class ShowImageState(State):
                     if cv2.waitKey(1) & 0xff == ord('q'):
                         sys.exit()
 
-            self.pipeline.execute_callbacks = [show_result]
+            self.pipeline.execute_callbacks = [AsyncCallback(show_result)]
 
     @property
     def pipeline(self):
@@ -346,12 +362,12 @@ class ShowImageState(State):
     @overrides(State)
     def on_enter(self):
         if GRAPHICAL_OUTPUT:
-            cv2.namedWindow("camera")
+            call_async(cv2.namedWindow, "camera")
 
     @overrides(State)
     def on_exit(self):
         if GRAPHICAL_OUTPUT:
-            cv2.destroyAllWindows()
+            call_async(cv2.destroyAllWindows)
 
     @overrides(State)
     def on_update(self, hist):
@@ -365,16 +381,16 @@ class ShowEdgesState(State):
         self.__pipeline = camera_pipelines.edge_detection_pipeline(100, 200)
 
         if GRAPHICAL_OUTPUT:
-            def show_result(*_):
-                image = self.pipeline["image"].output
-                edges = self.pipeline["edges"].output
+            def show_result(results):
+                _, image = results["image"]
+                _, edges = results["edges"]
                 
                 cv2.imshow("camera", image)
                 cv2.imshow("edges", edges)
                 if cv2.waitKey(1) & 0xff == ord('q'):
                     sys.exit()
 
-            self.pipeline.execute_callbacks = [show_result]
+            self.pipeline.execute_callbacks = [async_result_callback(show_result, self.pipeline, "image", "edges")]
 
     @property
     def pipeline(self):
@@ -383,13 +399,13 @@ class ShowEdgesState(State):
     @overrides(State)
     def on_enter(self):
         if GRAPHICAL_OUTPUT:
-            cv2.namedWindow("camera")
-            cv2.namedWindow("edges")
+            call_async(cv2.namedWindow, "camera")
+            call_async(cv2.namedWindow, "edges")
 
     @overrides(State)
     def on_exit(self):
         if GRAPHICAL_OUTPUT:
-            cv2.destroyAllWindows()
+            call_async(cv2.destroyAllWindows)
 
     @overrides(State)
     def on_update(self, hist):
@@ -414,6 +430,8 @@ class FindThresholdState(State):
                 if cv2.waitKey(1) & 0xff == ord('q'):
                     sys.exit()
 
+            # stays synchronous, as the trackbars are read in on_update and
+            # all HighGUI calls have to be made from the same thread
             self.pipeline.execute_callbacks = [show_result]
 
     @overrides(State)
@@ -473,10 +491,10 @@ class TestYDeviationState(State):
         self.__pipeline = camera_pipelines.color_tracking_pipeline("magenta")
 
         if GRAPHICAL_OUTPUT:
-            def show_result(*_):
-                bbox_ok, bbox = self.pipeline["contour_bbox"].result
-                image = self.pipeline["image"].output
-                dev_ok, dev = self.pipeline["y_deviation"].result
+            def show_result(results):
+                bbox_ok, bbox = results["contour_bbox"]
+                _, image = results["image"]
+                dev_ok, dev = results["y_deviation"]
 
                 # draw bounding box
                 if bbox_ok:
@@ -493,15 +511,16 @@ class TestYDeviationState(State):
                 if cv2.waitKey(1) & 0xff == ord('q'):
                     sys.exit()
 
-            self.pipeline.execute_callbacks = [show_result]
+            self.pipeline.execute_callbacks = [async_result_callback(show_result, self.pipeline,
+                                                                     "contour_bbox", "image", "y_deviation")]
 
     def on_enter(self):
         if GRAPHICAL_OUTPUT:
-            cv2.namedWindow('camtest', cv2.WINDOW_AUTOSIZE)
+            call_async(cv2.namedWindow, 'camtest', cv2.WINDOW_AUTOSIZE)
 
     def on_exit(self):
         if GRAPHICAL_OUTPUT:
-            cv2.destroyAllWindows()
+            call_async(cv2.destroyAllWindows)
 
     @property
     def pipeline(self):
@@ -1,5 +1,5 @@
 from logic.statemachine import *
-from utils.functions import current_time_millis
+from utils.functions import monotonic_ns, millis_since
 from sensors.bluetooth import bluetooth, bluetooth_pipelines
 from sensors import pipeline
 from sensors.camera import camera, camera_pipelines
@@ -22,19 +22,22 @@ class IDog(StateMachine):
         # Ultrasonic
         logging.debug("Starting US-Sensor")
         self.ultrasonic = ultrasonic.UltraSonic()
-        self.ultrasonic.start_thread()
+        if not config.USE_ASYNCIO:
+            self.ultrasonic.start_thread()
 
         # Infrared
         logging.debug("Starting IR-Sensor")
         self.infrared = infrared.InfraRed()
-        self.infrared.start_thread()
+        if not config.USE_ASYNCIO:
+            self.infrared.start_thread()
 
         # Bluetooth
         logging.debug("Starting BT-Dongles")
         self.bt_dongles = [bluetooth.BTDongle(i, config.BT_TARGET_UUID)
                            for i in config.BT_DONGLE_IDS]
-        for dongle in self.bt_dongles:
-            dongle.start()
+        if not config.USE_ASYNCIO:
+            for dongle in self.bt_dongles:
+                dongle.start()
 
         # RobotControl
         logging.debug("Starting RobotControl")
@@ -42,9 +45,27 @@ class IDog(StateMachine):
 
         # GestureControl
         logging.debug("Starting GestureControl")
-        self.gesture_control = gestures.Gesture()
+        self.gesture_control = gestures.Gesture(start_thread=not config.USE_ASYNCIO)
+
+        self._current_state.first_state = self.get_state(SearchState)
+
+    @overrides(StateMachine)
+    def _create_state(self, state_class):
+        return state_class(self)
+
+    @overrides(StateMachine)
+    def shutdown(self):
+        for dongle in self.bt_dongles:
+            dongle.stop()
+        bluetooth.REACTOR.stop()
 
-        self._current_state.first_state = SearchState(self)
+    @overrides(StateMachine)
+    def producers(self):
+        return [self.ultrasonic.produce(),
+                self.infrared.produce(),
+                *[dongle.produce() for dongle in self.bt_dongles],
+                self.gesture_control.produce(),
+                camera.READ_CAMERA_PIPELINE.produce()]
 
 
 class AbstractRobotState(State):
@@ -54,26 +75,40 @@ class AbstractRobotState(State):
         self.state_switching_timestamp = None
         self.state_machine = state_machine
 
+    @overrides(State)
+    def reset(self):
+        State.reset(self)
+        self.next_state = None
+        self.state_switching_timestamp = None
+
     def motor_alignment(self, dev):
         if abs(dev) > 0.2:
             value = interp1d([-1, 1], [-config.MAX_TURN_SPEED, config.MAX_TURN_SPEED])(dev)
             logging.debug("Current Turn Speed".format(value))
             self.state_machine.robots_control.rotate(max(config.MIN_TURN_SPEED, abs(value))*numpy.sign(value))
 
-    def show_result(self, *_):
+    def result_callbacks(self):
+        """ The execute callbacks of the state pipeline. The result is shown on
+        the callback thread, so that drawing never delays the motor control. """
+        if not config.GRAPHICAL_OUTPUT:
+            return []
+        return [pipeline.async_result_callback(self.show_result, self.pipeline,
+                                               "contour_bbox", "image", "y_deviation")]
+
+    def show_result(self, results):
         if config.GRAPHICAL_OUTPUT:
-            bbox_ok, bbox = self.pipeline["contour_bbox"].result
-            image = self.pipeline["image"].output
-            dev_ok, dev = self.pipeline["y_deviation"].result
+            bbox_ok, bbox = results["contour_bbox"]
+            _, image = results["image"]  # a copy, as camera frames are read-only
+            dev_ok, dev = results["y_deviation"]
 
-            # draw bounding box
-            if bbox_ok:
+            # draw bounding box (the camera branch may still be running in the background)
+            if bbox_ok and image is not None:
                 p1 = (int(bbox[0]), int(bbox[1]))
                 p2 = (int(bbox[0] + bbox[2]), int(bbox[1] + bbox[3]))
                 cv2.rectangle(image, p1, p2, (0, 0, 255))
 
             # add deviation as text
-            if dev_ok:
+            if dev_ok and image is not None:
                 cv2.putText(image, str(dev), (0, image.shape[0] - 5),
                             cv2.FONT_HERSHEY_SCRIPT_SIMPLEX, .6,
                             [0, 255, 0])
@@ -86,8 +121,8 @@ class AbstractRobotState(State):
     def queue_next_state(self, next_state):
         if self.next_state != type(next_state):
             self.next_state = type(next_state)
-            self.state_switching_timestamp = current_time_millis()
-        if current_time_millis() - self.state_switching_timestamp > config.STATE_SWITCH_COOLDOWN:
+            self.state_switching_timestamp = monotonic_ns()
+        if millis_since(self.state_switching_timestamp) > config.STATE_SWITCH_COOLDOWN:
             return next_state
         else:
             return self
@@ -115,10 +150,16 @@ class SearchState(AbstractRobotState):
                 camera_pipelines.color_tracking_pipeline(),
                 # Bluetooth inputs
                 bluetooth_pipelines.user_distance_estimation_pipeline(
-                    self.state_machine.bt_dongles)
+                    self.state_machine.bt_dongles),
+                priorities=(1, 0), deadline=config.SENSOR_DEADLINE,
+                quorum=config.SENSOR_QUORUM
             )
 
-        self.pipeline.execute_callbacks = [self.show_result]
+        self.pipeline.execute_callbacks = self.result_callbacks()
+
+    @overrides(AbstractRobotState)
+    def configure(self, start_spin_direction="left"):
+        self.start_spin_direction = start_spin_direction
 
     def on_enter(self):
         self.state_machine.gesture_control.change_gesture("search")
@@ -127,7 +168,7 @@ class SearchState(AbstractRobotState):
             self.state_machine.robots_control.left(config.SEARCH_SPEED)
         else:
             self.state_machine.robots_control.right(config.SEARCH_SPEED)
-        self.start_time = current_time_millis()
+        self.start_time = monotonic_ns()
 
     def on_exit(self):
         self.state_machine.robots_control.stop()
@@ -140,25 +181,24 @@ class SearchState(AbstractRobotState):
         pipeline_result = hist[-1]
         logging.debug("SearchState Pipeline results {}".format(hist[-1]))
         # unpack results
-        cam_ok, bt_ok = self.pipeline["y_deviation"].success_state, \
-                        self.pipeline["user_distance"].success_state
+        cam_ok, bt_ok = [succ for succ, _ in self.pipeline.branch_results]
         dev, distance = pipeline_result
         # if there are no result values go to wait state
         if not cam_ok and not bt_ok:
-            if current_time_millis() - self.start_time > config.SEARCH_TIMEOUT:
-                return WaitState(self.state_machine)
+            if millis_since(self.start_time) > config.SEARCH_TIMEOUT:
+                return self.state_machine.get_state(WaitState)
             return self
         if not cam_ok and bt_ok:
             # is bt distance far then go in wait state or timeout is reached go
             #  in wait state
-            if current_time_millis() - self.start_time > config.SEARCH_TIMEOUT or \
+            if millis_since(self.start_time) > config.SEARCH_TIMEOUT or \
                             distance == bluetooth.UserDistanceEstimationPipeline.Distance.FAR:
-                return WaitState(self.state_machine)
+                return self.state_machine.get_state(WaitState)
             return self
         if cam_ok and not bt_ok:
-            return TrackState(self.state_machine)
+            return self.state_machine.get_state(TrackState)
         if cam_ok and bt_ok:
-            return FollowState(self.state_machine)
+            return self.state_machine.get_state(FollowState)
 
 
 class FollowState(AbstractRobotState):
@@ -173,19 +213,21 @@ class FollowState(AbstractRobotState):
         self.__pipeline = \
             pipeline.DisjunctiveParallelPipeline(
                 # Camera inputs
-                camera_pipelines.color_tracking_pipeline(),
+                camera_pipelines.color_tracking_pipeline(roi=config.USE_ROI_TRACKING),
                 # Bluetooth inputs
                 bluetooth_pipelines.recommended_speed_pipeline(
                     self.state_machine.bt_dongles),
                 # InfraRed Input
                 infrared_piplelines.get_distance_pipeline(
-                    self.state_machine.infrared)
-
+                    self.state_machine.infrared),
+                priorities=(1, 0, 0), deadline=config.SENSOR_DEADLINE,
+                quorum=config.SENSOR_QUORUM
             )
 
-        self.pipeline.execute_callbacks = [self.show_result]
+        self.pipeline.execute_callbacks = self.result_callbacks()
 
     def on_enter(self):
+        self.last_dev = 0
         self.state_machine.gesture_control.change_gesture("follow")
 
     def on_exit(self):
@@ -200,28 +242,26 @@ class FollowState(AbstractRobotState):
 
         logging.debug("FollowState Pipeline results {}".format(hist[-1]))
         # unpack results
-        cam_ok, bt_ok, ir_ok = self.pipeline["y_deviation"].success_state, \
-                        self.pipeline["bt_speed"].success_state, \
-                        self.pipeline["ir_distance"].success_state
+        cam_ok, bt_ok, ir_ok = [succ for succ, _ in self.pipeline.branch_results]
 
         logging.debug("FollowState Pipeline results {}".format(cam_ok))
         dev, speed, distance = pipeline_result
 
         # if there are no result values go to wait state
         if not cam_ok and not bt_ok:
-            return self.queue_next_state(WaitState(self.state_machine))
+            return self.queue_next_state(self.state_machine.get_state(WaitState))
         if not cam_ok and bt_ok:
             # is bt distance far then go in wait state or timeout is reached go
             # in wait state
-            return self.queue_next_state(SearchState(self.state_machine,
-                                                     "left" if self.last_dev > 0 else "right"))
+            return self.queue_next_state(self.state_machine.get_state(
+                SearchState, start_spin_direction="left" if self.last_dev > 0 else "right"))
         if cam_ok and not bt_ok:
-            return self.queue_next_state(TrackState(self.state_machine))
+            return self.queue_next_state(self.state_machine.get_state(TrackState))
         if cam_ok and bt_ok:
             self.last_dev = dev
             self.motor_alignment(dev)
             if ir_ok and distance < config.MAX_IR_DISTANCE:
-                return self.queue_next_state(TrackState(self.state_machine))
+                return self.queue_next_state(self.state_machine.get_state(TrackState))
             if abs(dev) < 0.2:
                 self.state_machine.robots_control.forward(speed*config.FORWARD_SPEED_MULT)
             return self.queue_next_state(self)
@@ -238,18 +278,21 @@ class TrackState(AbstractRobotState):
         self.__pipeline = \
             pipeline.DisjunctiveParallelPipeline(
                 # Camera inputs
-                camera_pipelines.color_tracking_pipeline(),
+                camera_pipelines.color_tracking_pipeline(roi=config.USE_ROI_TRACKING),
                 # Bluetooth inputs
                 bluetooth_pipelines.user_distance_estimation_pipeline(
                     self.state_machine.bt_dongles),
                 # InfraRed Input
                 infrared_piplelines.get_distance_pipeline(
-                self.state_machine.infrared)
+                self.state_machine.infrared),
+                priorities=(1, 0, 0), deadline=config.SENSOR_DEADLINE,
+                quorum=config.SENSOR_QUORUM
             )
 
-        self.pipeline.execute_callbacks = [self.show_result]
+        self.pipeline.execute_callbacks = self.result_callbacks()
 
     def on_enter(self):
+        self.last_dev = 0
         self.state_machine.gesture_control.change_gesture("track")
 
     def on_exit(self):
@@ -264,18 +307,16 @@ class TrackState(AbstractRobotState):
         logging.debug("TrackState Pipeline results {}".format(hist[-1]))
 
         # unpack results
-        cam_ok, bt_ok, ir_ok = self.pipeline["y_deviation"].success_state, \
-                        self.pipeline["user_distance"].success_state, \
-                        self.pipeline["ir_distance"].success_state
+        cam_ok, bt_ok, ir_ok = [succ for succ, _ in self.pipeline.branch_results]
         dev, bt_distance, ir_distance = pipeline_result
         # if there are no result values go to wait state
         if not cam_ok and not bt_ok:
-            return self.queue_next_state(WaitState(self.state_machine))
+            return self.queue_next_state(self.state_machine.get_state(WaitState))
         if not cam_ok and bt_ok:
             # is bt distance far then go in wait state or timeout is reached go
             # in wait state
-            return self.queue_next_state(SearchState(
-                self.state_machine, "left" if self.last_dev > 0 else "right"))
+            return self.queue_next_state(self.state_machine.get_state(
+                SearchState, start_spin_direction="left" if self.last_dev > 0 else "right"))
         if cam_ok and not bt_ok:
             self.last_dev = dev
             self.motor_alignment(dev)
@@ -284,7 +325,7 @@ class TrackState(AbstractRobotState):
             self.last_dev = dev
             self.motor_alignment(dev)
             if ir_distance > config.MAX_IR_DISTANCE and bt_distance != bluetooth.UserDistanceEstimationPipeline.Distance.NEAR:
-                return self.queue_next_state(FollowState(self.state_machine))
+                return self.queue_next_state(self.state_machine.get_state(FollowState))
             return self.queue_next_state(self)
 
 
@@ -308,11 +349,12 @@ class WaitState(AbstractRobotState):
                     self.state_machine.ultrasonic),
                 # Infrared inputs
                 infrared_piplelines.get_movement_pipeline(
-                    self.state_machine.infrared)
-
+                    self.state_machine.infrared),
+                priorities=(1, 0, 0, 0), deadline=config.SENSOR_DEADLINE,
+                quorum=config.SENSOR_QUORUM
             )
 
-        self.pipeline.execute_callbacks = [self.show_result]
+        self.pipeline.execute_callbacks = self.result_callbacks()
 
     @property
     def pipeline(self):
@@ -320,36 +362,31 @@ class WaitState(AbstractRobotState):
 
     def on_enter(self):
         self.state_machine.gesture_control.change_gesture("wait")
-        self.start_time = current_time_millis()
+        self.start_time = monotonic_ns()
 
     def on_update(self, hist):
         pipeline_result = hist[-1]
         logging.debug("WaitState Pipeline results {}".format(hist[-1]))
         # unpack results
-        cam_ok, bt_ok, us_ok, ir_ok = self.pipeline[
-                                          "y_deviation"].success_state, \
-                                      self.pipeline[
-                                          "user_distance"].success_state, \
-                                      self.pipeline["us_change"].success_state, \
-                                      self.pipeline["ir_change"].success_state
+        cam_ok, bt_ok, us_ok, ir_ok = [succ for succ, _ in self.pipeline.branch_results]
 
         dev, distance, _, _ = pipeline_result
         # if there are no result values go to wait state
         if not cam_ok and not bt_ok:
 
-            if (us_ok or ir_ok) and current_time_millis() - self.start_time > config.IF_US_START_DELAY:
-                return SearchState(self.state_machine)
+            if (us_ok or ir_ok) and millis_since(self.start_time) > config.IF_US_START_DELAY:
+                return self.state_machine.get_state(SearchState)
             return self
         if not cam_ok and bt_ok:
 
             # is bt distance far then go in wait state or timeout is reached go
             # in wait state
             if distance == bluetooth.UserDistanceEstimationPipeline.Distance.NEAR \
-                    or ((us_ok or ir_ok) and current_time_millis() - self.start_time > config.IF_US_START_DELAY):
-                return SearchState(self.state_machine)
+                    or ((us_ok or ir_ok) and millis_since(self.start_time) > config.IF_US_START_DELAY):
+                return self.state_machine.get_state(SearchState)
             else:
                 return self
         if cam_ok and not bt_ok:
-            return TrackState(self.state_machine)
+            return self.state_machine.get_state(TrackState)
         if cam_ok and bt_ok:
-            return FollowState(self.state_machine)
+            return self.state_machine.get_state(FollowState)
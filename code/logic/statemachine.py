@@ -1,6 +1,91 @@
 from sensors import pipeline
-from utils.functions import overrides, current_time_millis
+from utils.functions import overrides, monotonic_ns, millis_since
+from utils import profiling, scheduling
+from collections import deque, namedtuple
+import asyncio
 import logging
+import numpy as np
+import config
+
+
+# A compact record of one state machine update at the monotonic_ns() time.
+# named maps the names of the state's named pipelines to their (success,
+# output) results.
+HistoryEntry = namedtuple("HistoryEntry", "time success output named")
+
+
+def _compact(value):
+    """ Strips images (arrays with at least two dimensions) from a pipeline output """
+    if isinstance(value, np.ndarray):
+        return value if value.ndim < 2 else None
+    if isinstance(value, tuple) and not hasattr(value, "_fields"):
+        return tuple(_compact(v) for v in value)
+    if isinstance(value, list):
+        return [_compact(v) for v in value]
+    return value
+
+
+def _detach(value):
+    """ Copies the images in a pipeline output, camera frames are views into
+    the capture ring and are overwritten by newer images """
+    if isinstance(value, np.ndarray):
+        return value.copy() if value.ndim >= 2 else value
+    if isinstance(value, tuple) and not hasattr(value, "_fields"):
+        return tuple(_detach(v) for v in value)
+    if isinstance(value, list):
+        return [_detach(v) for v in value]
+    return value
+
+
+class History(object):
+    """
+    A bounded history of the pipeline outputs of the state machine. Indexing
+    returns outputs like a list, hist[-1] being the newest one. Only the last
+    raw_depth outputs are stored with (copies of) their images, older ones are
+    compacted, i.e. camera images are replaced by None. entry(i) gives access to the success
+    flags and the results of the named pipelines (bbox, deviation, distances).
+    """
+
+    def __init__(self, depth=config.HISTORY_DEPTH, raw_depth=config.HISTORY_RAW_DEPTH):
+        self.__entries = deque(maxlen=depth)
+        self.__raw = deque(maxlen=max(0, min(raw_depth, depth)))
+
+    def append(self, output, pipeline):
+        named = getattr(pipeline, "named_pipelines", {})
+        self.__entries.append(HistoryEntry(
+            monotonic_ns(), pipeline.success_state, _compact(output),
+            {name: (p.success_state, _compact(p.output)) for name, p in named.items()}))
+        if self.__raw.maxlen > 0:
+            self.__raw.append(_detach(output))
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __normalize(self, index):
+        if index < 0:
+            index += len(self.__entries)
+        if not 0 <= index < len(self.__entries):
+            raise IndexError("history index out of range")
+        return index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        index = self.__normalize(index)
+        raw_index = index - (len(self.__entries) - len(self.__raw))
+        return self.__raw[raw_index] if raw_index >= 0 else self.__entries[index].output
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def entry(self, index):
+        """ Returns the HistoryEntry at the given index """
+        return self.__entries[self.__normalize(index)]
+
+
+def _log_producer_exit(task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("Sensor producer stopped", exc_info=task.exception())
 
 
 class StateMachine(object):
@@ -9,35 +94,121 @@ class StateMachine(object):
     def __init__(self):
         self._current_state = _InitialState()
 
-        self.__history = []
+        self.__history = History()
+        self.__states = {}
+        self.tick_budget = config.TICK_BUDGET
+        self.scheduler = scheduling.TickScheduler()
+        self.__updates = 0
 
     def run(self):
         try:
-            while True:
-                self.update()
+            if config.USE_ASYNCIO:
+                asyncio.run(self.run_async())
+            else:
+                while True:
+                    self.scheduler.wait()
+                    self.update()
         except KeyboardInterrupt:
             self._current_state.on_exit()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """ Stops the sensors when the state machine stops running """
+        pass
+
+    async def run_async(self):
+        """ Runs the sensor producers and the state machine on the event loop """
+        # keep references, the event loop only holds weak ones
+        tasks = [asyncio.ensure_future(producer) for producer in self.producers()]
+        for task in tasks:
+            task.add_done_callback(_log_producer_exit)
+        await asyncio.sleep(0)  # let the producers start before the first update
+
+        while True:
+            await self.scheduler.wait_async()
+            await self.update_async()
+
+    def producers(self):
+        """ Returns the coroutines of the sensors, which replace their threads
+        when the state machine runs on an event loop """
+        return []
 
     def update(self):
+        state_pipeline, start = self.__begin_update()
+        try:
+            pipeline_out = state_pipeline.run_pipeline(None)
+        finally:
+            pipeline.set_tick_budget(None)  # branches that finish in the background are not limited
+        self.__finish_update(state_pipeline, pipeline_out, start)
+
+    async def update_async(self):
+        """ update for the event loop, the state pipeline is awaited """
+        state_pipeline, start = self.__begin_update()
+        try:
+            pipeline_out = await state_pipeline.run_pipeline_async(None)
+        finally:
+            pipeline.set_tick_budget(None)
+        self.__finish_update(state_pipeline, pipeline_out, start)
+
+    def __begin_update(self):
         logging.debug("\nUpdating state machine (current state: " + str(self._current_state) + ")")
-        start = current_time_millis()
-        pipeline_out = self._current_state.pipeline.run_pipeline(None)
-        self.__history.append(pipeline_out)
+        start = monotonic_ns()
+        pipeline.MEMO_CACHE.clear()
+        pipeline.set_tick_budget(self.tick_budget)
+        return self._current_state.pipeline, start
+
+    def __finish_update(self, state_pipeline, pipeline_out, start):
+        self.__history.append(pipeline_out, state_pipeline)
+        self.__updates += 1
+        if config.PROFILE_REPORT_INTERVAL > 0 and self.__updates % config.PROFILE_REPORT_INTERVAL == 0:
+            logging.info("Pipeline profile of {}:\n{}".format(
+                self._current_state, profiling.format_report(pipeline.profile_report(state_pipeline))))
+            logging.info("Ticks: {}".format(scheduling.format_stats(self.scheduler.stats())))
         next_state = self._current_state.on_update(self.__history)
         self.set_state(next_state)
-        logging.debug("State machine updated ({}ms). New state: {}".format(
-            current_time_millis() - start, self._current_state))
+        logging.debug("State machine updated ({:.1f}ms). New state: {}".format(
+            millis_since(start), self._current_state))
 
     def set_state(self, state):
         if state is not self._current_state:
             self._current_state.on_exit()
+            # a branch of the old state pipeline that still runs in the
+            # background would share the camera with the new one
+            self._current_state.pipeline.finish_background()
             self._current_state = state
+            state.reset()
             state.on_enter()
 
+    def get_state(self, state_class, **params):
+        """ Returns the instance of state_class that is reused for every
+        transition to that state, creating it on first use. The params are
+        passed to the state's configure method. """
+        state = self.__states.get(state_class)
+        if state is None:
+            state = self._create_state(state_class)
+            self.__states[state_class] = state
+        state.configure(**params)
+        return state
+
+    def _create_state(self, state_class):
+        """ Creates a new instance of state_class for get_state """
+        return state_class()
+
 
 class State(object):
     """ Abstract superclass for all state machine states """
 
+    def configure(self, **params):
+        """ Called by StateMachine.get_state with the parameters of the
+        requested transition """
+        pass
+
+    def reset(self):
+        """ Called before on_enter. Resets the state and its pipeline, as
+        state objects are reused across transitions. """
+        self.pipeline.reset_state()
+
     def on_enter(self):
         """ Called when this state is entered"""
         pass
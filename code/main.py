@@ -32,10 +32,13 @@ def __parse_args():
     parser.add_argument("sm", type=str, help='What state machine to execute')
     parser.add_argument("smargs", nargs="*", help="Arguments to pass to the state machine")
     parser.add_argument('-v', '--verbose', action='store_const', const=True, default=False, help='Set verbose output')
+    parser.add_argument('--asyncio', action='store_const', const=True, default=False,
+                        help='Run the sensors and the state machine on an asyncio event loop')
 
     args = parser.parse_args()
 
     config.DEBUG_MODE = config.DEBUG_MODE or args.verbose
+    config.USE_ASYNCIO = config.USE_ASYNCIO or args.asyncio
     return args.sm, args.smargs
 
 
@@ -1,7 +1,10 @@
 # BLE Scanner based on https://github.com/switchdoclabs/iBeacon-Scanner-/blob/master/blescan.py
 # BLE = Bluetooth Low Energy
 
+import asyncio
+import errno
 import os
+import selectors
 import sys
 import struct
 import bluetooth._bluetooth as bluez
@@ -9,11 +12,13 @@ import math
 import time
 import logging
 from enum import Enum
-from collections import deque, namedtuple
+from collections import namedtuple
 from threading import Thread, Lock
 
 import config
-from utils.functions import current_time_millis, overrides
+from utils.functions import overrides, monotonic_ns, millis_to_ns
+from utils.rolling import RollingWindow, array_stats
+from utils.scheduling import SENSOR_EVENTS
 from sensors.pipeline import Pipeline
 
 
@@ -25,50 +30,66 @@ EVT_LE_CONN_COMPLETE = 0x01
 EVT_LE_ADVERTISING_REPORT = 0x02
 
 
-# Named tuple that represents the data that the ble scan returns
+# Named tuple that represents the data that the ble scan returns, the uuid
+# are the 16 raw bytes of the beacon uuid
 FindResult = namedtuple("FindResult", "uuid rssi")
 
 
-def returnstringpacket(pkt):
-    """Returns a packet as hex string"""
+# An HCI event packet starts with the packet type, the event code, the
+# parameter length and, for LE meta events, the subevent and the number of
+# reports
+_EVENT_HEADER = struct.Struct("BBBBB")
+# Every advertising report starts with the event type, the address type, the
+# address (6 bytes) and the data length, and is followed by the rssi
+_REPORT_HEADER_SIZE = 9
+_RSSI = struct.Struct("b")
+# iBeacon data ends with the uuid (16 bytes), major, minor (2 bytes each) and
+# the tx power
+_UUID_SIZE = 16
+_UUID_END = 5
 
-    myString = ""
-    for c in pkt:
-        myString += "%02x" % c
-    return myString
 
-
-def parse_events(sock, target_uuid, loop_count=100):
-    """Parses the events that the bluetooth socket recieves"""
+def install_filter(sock):
+    """Lets the socket receive all hci event packets. This only has to be
+    done once per socket. Returns the previous filter."""
     old_filter = sock.getsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, 14)
 
     flt = bluez.hci_filter_new()
     bluez.hci_filter_all_events(flt)
     bluez.hci_filter_set_ptype(flt, bluez.HCI_EVENT_PKT)
     sock.setsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, flt)
-
-    result = None
-    for i in range(0, loop_count):
-        pkt = sock.recv(255)
-        ptype, event, plen = struct.unpack("BBB", pkt[:3])
-        if event == LE_META_EVENT:
-            subevent = pkt[3]
-            pkt = pkt[4:]
-            if subevent == EVT_LE_ADVERTISING_REPORT:
-                num_reports = pkt[0]
-                report_pkt_offset = 0
-                for i in range(0, num_reports):
-                    uuid = returnstringpacket(
-                        pkt[report_pkt_offset - 22: report_pkt_offset - 6])
-                    rssi = struct.unpack("b", pkt[report_pkt_offset - 1:])[0]
-                    if uuid == target_uuid:
-                        result = FindResult(uuid, rssi)
-                        break
-                else:
-                    continue
-                break
-    sock.setsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, old_filter)
-    return result
+    return old_filter
+
+
+def parse_packet(pkt, targets):
+    """Returns a FindResult for every advertising report in an hci packet
+    (bytes) whose uuid is one of targets (a set or dict of 16 raw bytes
+    uuids)"""
+    view = memoryview(pkt)
+    size = len(view)
+    if size < _EVENT_HEADER.size:
+        return []
+    _, event, _, subevent, num_reports = _EVENT_HEADER.unpack_from(view)
+    if event != LE_META_EVENT or subevent != EVT_LE_ADVERTISING_REPORT:
+        return []
+
+    results = []
+    offset = _EVENT_HEADER.size
+    for _ in range(num_reports):
+        if offset + _REPORT_HEADER_SIZE > size:
+            break
+        data_end = offset + _REPORT_HEADER_SIZE + view[offset + _REPORT_HEADER_SIZE - 1]
+        if data_end >= size:
+            break
+        uuid_end = data_end - _UUID_END
+        if uuid_end - _UUID_SIZE >= offset + _REPORT_HEADER_SIZE:
+            # a read only byte memoryview hashes like bytes, so it is looked
+            # up without copying
+            uuid = view[uuid_end - _UUID_SIZE:uuid_end]
+            if uuid in targets:
+                results.append(FindResult(uuid.tobytes(), _RSSI.unpack_from(view, data_end)[0]))
+        offset = data_end + 1
+    return results
 
 
 # A named tuple that defines how the received rssi values are stored.
@@ -78,37 +99,48 @@ DataTuple = namedtuple("DataTuple", "time strength")
 
 
 class DataList:
-    """This is a snapshot of the bt dongle data. It contains multiple
-    values in a list and provides convenience methods to analyse the data"""
-
-    def __init__(self, threshold, data_list):
-        """threshold is the amount of time this snapshot is representing.
-        data_list is the list of DataTuple's"""
+    """This is a snapshot of the bt dongle data. It holds the times and
+    values in arrays and provides convenience methods to analyse the data.
+    The count, average and variance are computed at most once."""
+
+    def __init__(self, threshold, times, values, stats=None):
+        """threshold is the time from which on this snapshot contains the
+        data. times and values are arrays of the data, oldest first. stats
+        are the WindowStats of the values if they are already known, e.g.
+        from the RollingWindow the snapshot was taken from."""
         self.threshold = threshold
-        self.data_list = data_list
+        self.times = times
+        self.values = values
+        self.__stats = stats
+
+    @property
+    def stats(self):
+        """The WindowStats of the values"""
+        if self.__stats is None:
+            self.__stats = array_stats(self.values)
+        return self.__stats
+
+    @property
+    def data_list(self):
+        """The data as list of DataTuple's, newest first"""
+        return [DataTuple(int(t), float(strength))
+                for t, strength in zip(self.times[::-1], self.values[::-1])]
 
     def __len__(self):
         """Returns the amount of data this snapshot contains"""
-        return len(self.data_list)
+        return len(self.values)
 
     def avg(self):
         """Returns the average of all values"""
 
-        s = 0
-        for _, strength in self.data_list:
-            s += strength
-        count = len(self)
-        return s / count if count > 0 else 0
+        stats = self.stats
+        return stats.mean if stats.count > 0 else 0
 
     def variance(self):
         """Returns the variance of all values"""
 
-        s = 0
-        avg = self.avg()
-        for _, strength in self.data_list:
-            s += (strength - avg)**2
-        count = len(self)
-        return s / count if count > 0 else 0
+        stats = self.stats
+        return stats.variance if stats.count > 0 else 0
 
     def standard_deviation(self):
         """Returns the standard deviation of all values. Equivalent to
@@ -119,48 +151,71 @@ class DataList:
 
 class BTDongle:
     """Manages a single bluetooth dongle and stores the received data.
-    The data is stored in a double ended queue (deque) which allows
-    accessing the newest and oldest data in a very efficient way. For
-    performance reasons older data is being deleted, each time, new data
-    is inserted."""
+    The data of the target and of every further beacon is stored in its own
+    RollingWindow of BT_TIME_THRESHOLD ms, which keeps the average and
+    variance of the data up to date and can be read without blocking the
+    reactor thread. All beacons are recorded from one scan."""
 
-    def __init__(self, dev_id, target):
+    def __init__(self, dev_id, target, beacons=config.BT_BEACON_UUIDS):
         self.dev_id = dev_id
         self.target = target
 
         self.sock = None
-        self.data = deque()
-        self.lock = Lock()
+        # the windows by raw uuid, window is the one of the target
+        self.windows = {bytes.fromhex(uuid): RollingWindow(config.BT_TIME_THRESHOLD)
+                        for uuid in [target, *beacons]}
+        self.window = self.windows[bytes.fromhex(target)]
         self.current = 0
-        self.thread = Thread(target=self.scan_loop)
         self.offset = 0
 
-    def start(self):
-        """Initializes the bluetooth socket, and starts reading rssi values
-        in a new thread"""
+    def open(self):
+        """Initializes the non blocking bluetooth socket and enables the ble
+        scan"""
 
         # Open the bt socket
         self.sock = bluez.hci_open_dev(self.dev_id)
+        self.sock.setblocking(False)
+        install_filter(self.sock)
         # Enable ble scan
         bluez.hci_send_cmd(
             self.sock, OGF_LE_CTL, OCF_LE_SET_SCAN_ENABLE, struct.pack("<BB", 0x01, 0x00))
-        # Start scanning in a new thread
-        self.thread.start()
 
-    def remove_old_data(self, threshold=10000):
-        """Removes data tuples from the queue that are older
-        than threshold milliseconds"""
+    def start(self):
+        """Initializes the bluetooth socket, and lets the reactor thread,
+        which serves all dongles, read the rssi values"""
 
-        threshold = current_time_millis() - threshold
+        self.open()
+        REACTOR.register(self)
+
+    def stop(self):
+        """Stops reading and closes the bluetooth socket"""
+
+        if self.sock is None:
+            return
+        # waits for a read of the reactor thread, so the socket is not in use
+        REACTOR.unregister(self)
+        self.sock.close()
+        self.sock = None
+
+    async def produce(self):
+        """Reads rssi values on the event loop of the asyncio runtime instead
+        of in a thread. A packet is only read when the socket is readable."""
+
+        if self.sock is None:
+            self.open()
+        loop = asyncio.get_running_loop()
+        fd = self.sock.fileno()
+        loop.add_reader(fd, self.read_packets)
         try:
-            self.lock.acquire()
-            while(len(self.data) > 0 and self.data[0].time < threshold):
-                self.data.popleft()
+            await loop.create_future()  # runs until the task is cancelled
         finally:
-            self.lock.release()
+            loop.remove_reader(fd)
 
-    def add_data(self, rssi):
-        """Adds a new rssi value. This also calls self.remove_old_data()"""
+    def add_data(self, rssi, uuid=None, now=None):
+        """Adds a new rssi value of the beacon with the raw uuid (default:
+        the target), received at the monotonic_ns() time now (default: the
+        current time). Values
+        older than the window are removed"""
 
         # Positive rssi values are very rare, and indicate a very
         # good connection. We simplify this by setting the value to
@@ -168,47 +223,107 @@ class BTDongle:
         if rssi > 0:
             rssi = 0
 
-        # Remove old entries from the queue that are older than 10 sec
-        self.remove_old_data()
-        # Add the new rssi value to the data queue
-        try:
-            self.lock.acquire()
-            self.data.append(DataTuple(
-                current_time_millis(), abs(rssi) + self.offset))
-        finally:
-            self.lock.release()
+        # Add the new rssi value to the data window
+        window = self.window if uuid is None else self.windows[uuid]
+        window.append(abs(rssi) + self.offset, now)
+        SENSOR_EVENTS.notify("bluetooth")
+
+    def read_packets(self, max_packets=config.BT_READ_BATCH):
+        """Reads the available packets, at most max_packets, without
+        blocking. Every packet is timestamped when it is received."""
+
+        packets = []
+        for _ in range(max_packets):
+            try:
+                pkt = self.sock.recv(255)
+            except OSError as e:  # bluez.error is an OSError
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            packets.append((monotonic_ns(), pkt))
 
-    def scan(self):
-        """Scans a single time for ble beacons"""
+        for now, pkt in packets:
+            for result in parse_packet(pkt, self.windows):
+                self.add_data(result.rssi, result.uuid, now)
 
-        result = parse_events(self.sock, self.target, loop_count=10)
-        if result != None:
-            self.add_data(result.rssi)
+    def snapshot_data(self, uuid=None):
+        """Returns a snapshot of the data of the beacon with the given uuid
+        (hex string, default: the target) in form of a DataList object.
+        This contains all data that has been collected in the last threshold
+        milliseconds"""
+        threshold = monotonic_ns() - millis_to_ns(config.BT_TIME_THRESHOLD)
 
-    def scan_loop(self):
-        """Scans in a loop for ble beacons. Simply calls self.scan() in a
-        while True loop"""
+        window = self.window if uuid is None else self.windows[bytes.fromhex(uuid)]
+        return DataList(threshold, *window.snapshot(threshold))
 
-        while True:
-            self.scan()
 
-    def snapshot_data(self):
-        """Returns a snapshot of the data in form of a DataList object.
-        This contains all data that has been collected in the last threshold
-        milliseconds"""
-        threshold = current_time_millis() - config.BT_TIME_THRESHOLD
+class BTReactor:
+    """Reads the packets of all started dongles in a single thread. The
+    non blocking sockets are multiplexed with a selector (epoll on linux)
+    and every wakeup reads a batch of packets from each readable socket."""
 
-        data_list = []
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = Lock()
+        self.thread = None
+        self.running = False
+        # stop and register write to this pipe to wake the thread up
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        self.selector.register(self.wake_read, selectors.EVENT_READ)
+
+    def register(self, dongle):
+        """Starts reading the socket of an opened dongle"""
+
+        with self.lock:
+            self.selector.register(dongle.sock.fileno(), selectors.EVENT_READ, dongle)
+            if self.thread is None:
+                self.running = True
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+        os.write(self.wake_write, b"\0")
+
+    def unregister(self, dongle):
+        """Stops reading the socket of a dongle. The reactor thread reads
+        under the lock, so once this returns the socket is no longer used
+        and can be closed."""
+
+        with self.lock:
+            self.__unregister(dongle)
+        os.write(self.wake_write, b"\0")
+
+    def __unregister(self, dongle):
         try:
-            self.lock.acquire()
-            for t in reversed(self.data):
-                # Stop when data is too old
-                if t.time < threshold:
-                    break
-                data_list.append(t)
-        finally:
-            self.lock.release()
-        return DataList(threshold, data_list)
+            self.selector.unregister(dongle.sock.fileno())
+        except KeyError:
+            pass  # not registered
+
+    def run(self):
+        while self.running:
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    os.read(self.wake_read, 512)
+                    continue
+                with self.lock:
+                    # the dongle may have been unregistered since the select
+                    if self.selector.get_map().get(key.fd) is not key:
+                        continue
+                    try:
+                        key.data.read_packets()
+                    except Exception:
+                        # a failing dongle must not stop the others
+                        logging.exception("Reading bt dongle {} failed".format(key.data.dev_id))
+                        self.__unregister(key.data)
+
+    def stop(self):
+        """Stops the reactor thread"""
+
+        with self.lock:
+            thread, self.thread = self.thread, None
+            self.running = False
+        os.write(self.wake_write, b"\0")
+        if thread is not None:
+            thread.join()
 
 
 class SnapshotBTDataPipeline(Pipeline):
@@ -288,3 +403,5 @@ class UserDistanceEstimationPipeline(Pipeline):
             return True, self.Distance.MEDIUM
         return True, self.Distance.NEAR
 
+
+REACTOR = BTReactor()
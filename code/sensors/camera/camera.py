@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import sys
 import time
@@ -5,13 +6,14 @@ import sklearn.cluster
 
 import cv2
 import numpy as np
-import itertools
 import random
-from threading import Thread
+from contextlib import contextmanager
+from threading import Thread, Condition, Lock, local
 
 from config.config import *
-from sensors.pipeline import Pipeline
-from utils.functions import overrides, get_class_name, current_time_millis, deprecated
+from sensors.pipeline import Pipeline, CompositePipeline, remaining_tick_time
+from utils.functions import overrides, get_class_name, deprecated, monotonic_ns
+from utils.scheduling import SENSOR_EVENTS, get_sensor_executor
 from scipy.interpolate import interp1d
 
 if os.uname().machine == 'armv7l':  # probably runnig on RaspPi
@@ -20,50 +22,202 @@ if os.uname().machine == 'armv7l':  # probably runnig on RaspPi
 else:
     picamera = None
 
-# create and setup the camera object
-if picamera is None or USE_USB_CAMERA:
-    camera = cv2.VideoCapture(0 if picamera is None else 0)
-    camera.set(cv2.CAP_PROP_FRAME_WIDTH, CAMERA_RESOLUTION[0])
-    camera.set(cv2.CAP_PROP_FRAME_HEIGHT, CAMERA_RESOLUTION[1])
-    # camera.set(cv2.CAP_PROP_AUTO_EXPOSURE, 0)
-    # camera.set(cv2.CAP_PROP_EXPOSURE, .0001)
-    # camera.set(cv2.CAP_PROP_AUTOFOCUS, 0)
-    # camera.set(cv2.CAP_PROP_GAIN, 1)
-    # camera.set(cv2.CAP_PROP_BACKLIGHT, 100)
-    # camera.set(cv2.CAP_PROP_SETTINGS, 1)
-
-    picamera = None
-else:
-    camera = picamera.PiCamera()
-    # camera.resolution = PYCAMERA_RESOLUTION
-    camera.framerate = 32
-    camera.exposure_mode = "antishake"
+camera = None
+
+
+def open_camera():
+    """ Creates and sets up the camera object. This is done on the first
+    capture instead of on import, so that worker processes of process
+    parallel pipelines can import this module without opening the camera. """
+    global camera, picamera
+    if camera is not None:
+        return
+    if picamera is None or USE_USB_CAMERA:
+        camera = cv2.VideoCapture(0 if picamera is None else 0)
+        camera.set(cv2.CAP_PROP_FRAME_WIDTH, CAMERA_RESOLUTION[0])
+        camera.set(cv2.CAP_PROP_FRAME_HEIGHT, CAMERA_RESOLUTION[1])
+        # camera.set(cv2.CAP_PROP_AUTO_EXPOSURE, 0)
+        # camera.set(cv2.CAP_PROP_EXPOSURE, .0001)
+        # camera.set(cv2.CAP_PROP_AUTOFOCUS, 0)
+        # camera.set(cv2.CAP_PROP_GAIN, 1)
+        # camera.set(cv2.CAP_PROP_BACKLIGHT, 100)
+        # camera.set(cv2.CAP_PROP_SETTINGS, 1)
+
+        picamera = None
+    else:
+        camera = picamera.PiCamera()
+        # camera.resolution = PYCAMERA_RESOLUTION
+        camera.framerate = 32
+        camera.exposure_mode = "antishake"
+
+
+# The area of the full camera image, relative to which the minimum size of a
+# detected object is given, while a detector only sees a window or a
+# downscaled copy of it (per thread, see detection_reference)
+_detection_reference = local()
+
+
+def _reference_area():
+    return getattr(_detection_reference, "area", None)
+
+
+def _min_detection_area(image, min_size):
+    """ The minimum area of an object that is detected in image """
+    area = _reference_area()
+    return (image.shape[0] * image.shape[1] if area is None else area) * min_size
+
+
+@contextmanager
+def detection_reference(image, scale=1):
+    """ Within this context, detectors that are given a window of image (or
+    of image downscaled by scale) apply the minimum object size of image """
+    previous = _reference_area()
+    area = image.shape[0] * image.shape[1] if previous is None else previous
+    _detection_reference.area = area * scale * scale
+    try:
+        yield
+    finally:
+        _detection_reference.area = previous
+
+
+class Frame(np.ndarray):
+    """ A camera image that additionally carries a monotonically increasing
+    frame id and the monotonic_ns() time it was captured. Views and slices of a frame keep
+    both attributes, results of cv2 functions are plain arrays. """
+
+    def __array_finalize__(self, obj):
+        self.frame_id = getattr(obj, "frame_id", None)
+        self.timestamp = getattr(obj, "timestamp", None)
+
+    @staticmethod
+    def wrap(image, frame_id, timestamp):
+        frame = image.view(Frame)
+        frame.frame_id = frame_id
+        frame.timestamp = timestamp
+        return frame
 
 
 class _ReadCameraPipeline(Pipeline):
+    """ Returns the newest camera frame as a read-only Frame. The frame is only
+    borrowed: its buffer is reused by the capture thread once the pipeline has
+    been executed again, so copy it to keep or modify it. """
 
-    def __init__(self):
+    def __init__(self, wait_for_new_frame=CAMERA_WAIT_FOR_NEW_FRAME):
         Pipeline.__init__(self)
 
+        # if set, the pipeline blocks until a frame arrives that has not been
+        # returned before (at most CAMERA_FRAME_TIMEOUT ms or the rest of the tick budget)
+        self.wait_for_new_frame = wait_for_new_frame
+
+        # The capture thread writes into a fixed ring of preallocated buffers.
+        # The newest frame and the one that was returned last (borrowed by the
+        # consumer until the next call) are never overwritten.
+        self.__buffers = [np.empty((CAMERA_RESOLUTION[1], CAMERA_RESOLUTION[0], 3), dtype=np.uint8)
+                          for _ in range(max(3, CAMERA_RING_SIZE))]
+        self.__latest_slot = None
+        self.__borrowed_slot = None
+
         self.__last_sucess = False
         self.__last_capture = None
+        self.__frame_id = 0
+        self.__consumed_id = 0
+        self.__skipped_frames = 0
+        self.__new_frame = Condition()
+
+        # the capture thread is started on the first execution, unless the
+        # frames are produced by produce() on an event loop
+        self.__capturing = False
+        self.__start_lock = Lock()
+
+    def start(self):
+        """ Starts the capture thread and gives the camera time to adjust.
+        Concurrent callers wait until it is started. """
+        with self.__start_lock:
+            if not self.__capturing:
+                self.__capturing = True
+                open_camera()
+                Thread(target=self.__read, daemon=True).start()
+                time.sleep(2)
+
+    async def produce(self):
+        """ Captures frames on the sensor pool for the asyncio runtime,
+        instead of in a dedicated capture thread """
+        with self.__start_lock:
+            self.__capturing = True
+            open_camera()
+        loop = asyncio.get_running_loop()
+        while True:
+            await loop.run_in_executor(get_sensor_executor(), self.__capture)
+
+    @property
+    def frame_id(self):
+        """ The id of the newest captured frame """
+        return self.__frame_id
+
+    @property
+    def skipped_frames(self):
+        """ The number of captured frames that were never returned """
+        return self.__skipped_frames
+
+    def __next_slot(self):
+        """ Returns the index of the next buffer that may be overwritten """
+        start = self.__latest_slot if self.__latest_slot is not None else -1
+        for i in range(1, len(self.__buffers) + 1):
+            slot = (start + i) % len(self.__buffers)
+            if slot != self.__latest_slot and slot != self.__borrowed_slot:
+                return slot
 
-        Thread(target=self.__read).start()
-        time.sleep(2)
-        
     def __read(self):
         while True:
-            if picamera is None:
-                self.__last_sucess, self.__last_capture = camera.read()
-            else:
-                array = picamera.array.PiRGBArray(camera, size=CAMERA_RESOLUTION)
-                camera.capture(array, format='bgr', resize=CAMERA_RESOLUTION, use_video_port=True)
-
-                self.__last_capture = array.array
-                self.__last_sucess = True
+            self.__capture()
+
+    def __capture(self):
+        """ Captures a single frame into the next free buffer """
+        with self.__new_frame:
+            slot = self.__next_slot()
+        buffer = self.__buffers[slot]
+
+        if picamera is None:
+            succ, capture = camera.read(buffer)
+            if succ and capture is not None and capture is not buffer:
+                # the camera delivers another size than configured, so
+                # adopt the buffer that cv2 allocated
+                self.__buffers[slot] = capture
+        else:
+            camera.capture(buffer, format='bgr', resize=CAMERA_RESOLUTION, use_video_port=True)
+            succ, capture = True, buffer
+        timestamp = monotonic_ns()
+
+        with self.__new_frame:
+            if succ and capture is not None:
+                self.__frame_id += 1
+                self.__latest_slot = slot
+                frame = Frame.wrap(capture, self.__frame_id, timestamp)
+                frame.flags.writeable = False
+                self.__last_capture = frame
+            self.__last_sucess = succ
+            self.__new_frame.notify_all()
+        if succ and capture is not None:
+            SENSOR_EVENTS.notify("camera")
 
     def _execute(self, inp):
-        return self.__last_sucess and self.__last_capture is not None, self.__last_capture
+        self.start()
+
+        timeout = CAMERA_FRAME_TIMEOUT
+        remaining = remaining_tick_time()
+        if remaining is not None:
+            timeout = max(0, min(timeout, remaining))
+
+        with self.__new_frame:
+            if self.wait_for_new_frame and not self.__new_frame.wait_for(
+                    lambda: self.__frame_id > self.__consumed_id, timeout=timeout / 1000):
+                return False, None
+
+            if self.__frame_id > self.__consumed_id:
+                self.__skipped_frames += self.__frame_id - self.__consumed_id - 1
+                self.__consumed_id = self.__frame_id
+            self.__borrowed_slot = self.__latest_slot
+            return self.__last_sucess and self.__last_capture is not None, self.__last_capture
 
 
 class ConvertColorspacePipeline(Pipeline):
@@ -74,6 +228,11 @@ class ConvertColorspacePipeline(Pipeline):
 
         self.__target_colorspace = to
 
+    @property
+    @overrides(Pipeline)
+    def memo_key(self):
+        return ConvertColorspacePipeline, self.__target_colorspace
+
     @overrides(Pipeline)
     def _execute(self, inp):
         """
@@ -119,6 +278,15 @@ class ColorThresholdPipeline(Pipeline):
         else:
             raise ValueError('Unsupported argument type', type(color), '(must be str or tuple)')
 
+    @property
+    def thresholds(self):
+        return self.threshold_lower, self.threshold_upper
+
+    @property
+    @overrides(Pipeline)
+    def memo_key(self):
+        return ColorThresholdPipeline, tuple(self.threshold_lower), tuple(self.threshold_upper)
+
     @overrides(Pipeline)
     def _execute(self, inp):
         """
@@ -129,9 +297,122 @@ class ColorThresholdPipeline(Pipeline):
         return True, colmask
 
 
+class ColorMaskPipeline(Pipeline):
+    """
+    Creates a binary image of the pixels in the given color threshold directly
+    from a BGR image (fuses ConvertColorspacePipeline and ColorThresholdPipeline).
+    The image is converted into a reused HSV buffer and thresholded into a
+    reused mask, so the mask is only valid until the next run.
+    """
+
+    def __init__(self, color):
+        Pipeline.__init__(self)
+
+        lower, upper = ColorThresholdPipeline(color).thresholds
+        self.__threshold_lower = tuple(float(v) for v in lower)
+        self.__threshold_upper = tuple(float(v) for v in upper)
+
+        self.__buffers = None
+
+    @property
+    @overrides(Pipeline)
+    def memo_key(self):
+        return ColorMaskPipeline, self.__threshold_lower, self.__threshold_upper
+
+    def __get_buffers(self, shape):
+        if self.__buffers is None or self.__buffers[0].shape != shape:
+            self.__buffers = (np.empty(shape, dtype=np.uint8), np.empty(shape[:2], dtype=np.uint8))
+        return self.__buffers
+
+    @overrides(Pipeline)
+    def _execute(self, inp):
+        """
+        :param inp: BGR-image (np.array)
+        :return: A binary image (np.array)
+        """
+        hsv, mask = self.__get_buffers(inp.shape)
+        cv2.cvtColor(inp, cv2.COLOR_BGR2HSV, dst=hsv)
+        return True, cv2.inRange(hsv, self.__threshold_lower, self.__threshold_upper, dst=mask)
+
+
+class MultiColorThresholdPipeline(Pipeline):
+    """
+    Thresholds an image for up to 8 colors in a single traversal. The result
+    is a label image, in which bit i of a pixel is set if the pixel is in the
+    threshold of the i-th color. As every threshold is a box in color space,
+    a per channel lookup of the colors that accept the channel value, ANDed
+    over all channels, yields exactly these bits.
+    """
+
+    def __init__(self, colors):
+        Pipeline.__init__(self)
+
+        if not 0 < len(colors) <= 8:
+            raise ValueError('Unsupported number of colors', len(colors), '(must be 1 to 8)')
+        self.colors = list(colors)
+
+        self.__lut = np.zeros((256, 1, 3), dtype=np.uint8)
+        values = np.arange(256)
+        for i, color in enumerate(self.colors):
+            lower, upper = ColorThresholdPipeline(color).thresholds
+            for channel in range(3):
+                accepted = (values >= lower[channel]) & (values <= upper[channel])
+                self.__lut[accepted, 0, channel] |= 1 << i
+
+    def bit(self, color):
+        """ Returns the bit of the given color in the label image """
+        return 1 << self.colors.index(color)
+
+    @property
+    @overrides(Pipeline)
+    def memo_key(self):
+        return MultiColorThresholdPipeline, tuple(self.colors)
+
+    @overrides(Pipeline)
+    def _execute(self, inp):
+        """
+        :param inp: an image in the color space of the thresholds (np.array)
+        :return: the label image (np.array)
+        """
+        first, second, third = cv2.split(cv2.LUT(inp, self.__lut))
+        return True, cv2.bitwise_and(cv2.bitwise_and(first, second), third)
+
+
+class MultiColorBBoxPipeline(Pipeline):
+    """ Finds the largest object of every color in a label image of a
+    MultiColorThresholdPipeline and returns a dict that maps each color to its
+    bounding box (None if the color was not found) """
+
+    def __init__(self, colors, min_contour_size=DETECTION_SIZE_THRESHOLD):
+        Pipeline.__init__(self)
+
+        self.colors = list(colors)
+        self.__filter = ErodeDilatePipeline()
+        self.__contour = GetLargestContourPipeline(min_contour_size)
+
+    @overrides(Pipeline)
+    def _execute(self, inp):
+        """
+        :param inp: a label image (np.array)
+        :return: the bounding boxes (dict color -> tuple (x, y, w, h) )
+        """
+        bboxes = {}
+        for i, color in enumerate(self.colors):
+            mask = cv2.compare(cv2.bitwise_and(inp, 1 << i), 0, cv2.CMP_GT)
+            _, filtered = self.__filter._execute(mask)
+            found, bbox = self.__contour._execute(filtered)
+            bboxes[color] = bbox if found else None
+        return any(bbox is not None for bbox in bboxes.values()), bboxes
+
+
 class ErodeDilatePipeline(Pipeline):
     """ Applies an erode and dilate filter on an image """
 
+    @property
+    @overrides(Pipeline)
+    def memo_key(self):
+        return ErodeDilatePipeline,
+
     @overrides(Pipeline)
     def _execute(self, inp):
         """
@@ -151,99 +432,129 @@ class GetLargestContourPipeline(Pipeline):
 
         self.__min_contour_size = min_contour_size
 
+    @property
+    @overrides(Pipeline)
+    def memo_key(self):
+        return GetLargestContourPipeline, self.__min_contour_size, _reference_area()
+
     @overrides(Pipeline)
     def _execute(self, inp):
         """
         :param inp: a binary image (np.array)
         :return: a bounding box (tuple (x, y, w, h) )
         """
-        _, cnts, _ = cv2.findContours(inp, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+        cnts = cv2.findContours(inp, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)[-2]  # cv2 3.x returns 3 values
 
         # only proceed if at least one contour was found
         if len(cnts) > 0:
             largest_contour = max(cnts, key=cv2.contourArea)
 
-            if cv2.contourArea(largest_contour) > inp.shape[0] * inp.shape[1] * self.__min_contour_size:
+            if cv2.contourArea(largest_contour) > _min_detection_area(inp, self.__min_contour_size):
                 bbox = tuple(cv2.boundingRect(largest_contour))
                 return True, bbox
 
         return False, None
 
 
-class FastColorDetectionPipeline(Pipeline):
-    """ A heuristical color detection approach. Not actually fast. """
+def _find_runs(lines, min_length):
+    """
+    Finds the runs of true values along the rows of a 2d array
+    :param lines: a 2d boolean array, every row is a scanline
+    :param min_length: runs must be longer than this
+    :return: three arrays (scanline index, start, end), the end is exclusive
+    """
+    n_lines, length = lines.shape
+    padded = np.zeros((n_lines, length + 2), dtype=bool)
+    padded[:, 1:-1] = lines
 
-    def __init__(self, color):
+    # every padded scanline starts and ends with a zero, so the edges
+    # alternate between the start and the end of a run
+    edges = np.flatnonzero(padded[:, 1:] != padded[:, :-1])
+    starts, ends = edges[0::2], edges[1::2]
+    keep = ends - starts > min_length
+    starts, ends = starts[keep], ends[keep]
+
+    line = starts // (length + 1)
+    return line, starts - line * (length + 1), ends - line * (length + 1)
+
+
+class FastColorDetectionPipeline(Pipeline):
+    """
+    A heuristical color detection approach. Finds colored runs on every
+    scanline_distance-th row and column and returns the largest box that is
+    spanned by a crossing pair of a horizontal and a vertical run. When a color
+    is given, the BGR image can be passed in directly and only the scanlines
+    are converted and thresholded, which is a lot cheaper than converting,
+    filtering and contour searching the whole image.
+    """
+
+    def __init__(self, color=None, min_size=DETECTION_SIZE_THRESHOLD, scanline_distance=SCANLINE_DISTANCE):
         Pipeline.__init__(self)
 
-        if type(color) == str:
-            if color == 'red':
-                self.threshold_lower = np.array([140, 50, 50])
-                self.threshold_upper = np.array([160, 255, 255])
-            elif color == 'yellow':
-                self.threshold_lower = np.array([30, 50, 50])
-                self.threshold_upper = np.array([70, 255, 255])
-            elif color == 'orange':
-                self.threshold_lower = np.array([15, 50, 50])
-                self.threshold_upper = np.array([25, 255, 255])
-            elif color == 'magenta':
-                self.threshold_lower = np.array([interp1d([0, 360], [0, 180])(300),
-                                                 interp1d([0, 100], [0, 255])(10),
-                                                 interp1d([0, 100], [0, 255])(10)])
-                self.threshold_upper = np.array([interp1d([0, 360], [0, 180])(330),
-                                                 interp1d([0, 100], [0, 255])(100),
-                                                 interp1d([0, 100], [0, 255])(100)])
-            else:
-                raise ValueError('Unsupported color', color)
-        elif type(color) == tuple:
-            self.threshold_lower, self.threshold_upper = color
-        else:
-            raise ValueError('Unsupported argument type', type(color), '(must be str or tuple)')
+        if color is not None:
+            self.threshold_lower, self.threshold_upper = ColorThresholdPipeline(color).thresholds
+        self.__min_size = min_size
+        self.__scanline_distance = scanline_distance
+
+    def __threshold(self, image):
+        return cv2.inRange(cv2.cvtColor(image, cv2.COLOR_BGR2HSV), self.threshold_lower, self.threshold_upper)
 
+    @overrides(Pipeline)
     def _execute(self, inp):
-        height, width = inp.shape
+        """
+        :param inp: a binary image or, if a color was given, a BGR image (np.array)
+        :return: a bounding box (tuple (x, y, w, h) )
+        """
+        height, width = inp.shape[:2]
+        step = self.__scanline_distance
+        n_rows, n_cols = (height + step - 1) // step, width // step
+
+        # Sample the scanlines. Nearest neighbour resizing by an integer factor
+        # picks every step-th column and is much faster than strided indexing.
+        rows = inp[::step]
+        cols = cv2.resize(inp[:, :n_cols * step], (n_cols, height), interpolation=cv2.INTER_NEAREST)
+        if inp.ndim == 3:
+            rows, cols = self.__threshold(rows), self.__threshold(cols)
+
+        h_rows, h_x1, h_x2 = _find_runs(rows > 0, step)
+        v_cols, v_y1, v_y2 = _find_runs(cv2.transpose(cols) > 0, step)
+        if len(h_rows) == 0 or len(v_cols) == 0:
+            return False, None
 
-        startt = current_time_millis()
-        horizontal_segments = []
-        for y in range(0, height, SCANLINE_DISTANCE):
-            start = None
-            for x in range(0, width):
-                if self.__pixel_in_range(inp[y, x]):
-                    if start is None:
-                        start = x
-                elif start is not None and x - start > SCANLINE_DISTANCE:
-                    horizontal_segments.append((y, start, x))
-                    start = None
-        print("HSCAN", current_time_millis() - startt)
-
-        startt = current_time_millis()
-        vertical_segments = []
-        for x in range(0, width, SCANLINE_DISTANCE):
-            start = None
-            for y in range(0, height):
-                if self.__pixel_in_range(inp[y, x]):
-                    if start is None:
-                        start = y
-                elif start is not None and y - start > SCANLINE_DISTANCE:
-                    vertical_segments.append((x, start, y))
-                    start = None
-        print("VSCAN", current_time_millis() - startt)
-
-        startt = current_time_millis()
-        largest_bbox = None
-        largest_area = 0
-        for (hy, hx1, hx2), (vx, vy1, vy2) in itertools.product(horizontal_segments, vertical_segments):
-            if vy1 <= hy <= vy2 and hx1 <= vx <= hx2:
-                w, h = hx2 - hx1, vy2 - vy1
-                if w*h > largest_area:
-                    largest_bbox = (hx1, vy1, w, h)
-        print("BBOX", current_time_millis() - startt)
-
-        return largest_bbox is None, largest_bbox
-
-    def __pixel_in_range(self, pixel):
-        return pixel > 0
-        #return np.all(pixel >= self.threshold_lower) and np.all(pixel <= self.threshold_upper)
+        # Paint the height of the covering vertical run onto every scan point
+        # (crossing of a scanned row and column). The runs of a column are
+        # disjoint, so a cumulative sum over +height at the first and -height
+        # after the last scanned row of every run does this. Runs are longer
+        # than step, so each of them covers at least one scanned row / column.
+        v_heights = (v_y2 - v_y1).astype(np.int32)
+        heights = np.zeros((n_rows + 1, n_cols), dtype=np.int32)
+        heights[-(-v_y1 // step), v_cols] = v_heights
+        heights[(v_y2 - 1) // step + 1, v_cols] -= v_heights
+        heights = np.cumsum(heights, axis=0, out=heights)
+
+        # Sweep over the horizontal runs sorted by row and start (the order
+        # nonzero yields them in) and take the highest vertical run each one
+        # crosses. The scanned columns of consecutive runs do not overlap, so
+        # a single reduceat over interleaved (first, last + 1) bounds does this.
+        # The last row of heights is zero and catches the final bound.
+        col_first = -(-h_x1 // step)
+        col_end = np.minimum((h_x2 - 1) // step + 1, n_cols)
+        bounds = np.empty(2 * len(h_rows), dtype=np.intp)
+        bounds[0::2] = h_rows * n_cols + col_first
+        bounds[1::2] = h_rows * n_cols + col_end
+        max_heights = np.maximum.reduceat(heights.ravel(), bounds)[0::2]
+        max_heights[col_first >= col_end] = 0  # only crosses the cut off last column
+
+        areas = (h_x2 - h_x1) * max_heights
+        best = np.argmax(areas)
+        if areas[best] == 0 or areas[best] <= _min_detection_area(inp, self.__min_size):
+            return False, None
+
+        row, first = h_rows[best], col_first[best]
+        col = first + np.argmax(heights[row, first:col_end[best]])
+        y = row * step
+        v_run = np.flatnonzero((v_cols == col) & (v_y1 <= y) & (v_y2 > y))[0]
+        return True, (int(h_x1[best]), int(v_y1[v_run]), int(h_x2[best] - h_x1[best]), int(v_heights[v_run]))
 
 
 class TrackBBOXPipeline(Pipeline):
@@ -268,6 +579,142 @@ class TrackBBOXPipeline(Pipeline):
         return self.__tracker.update(inp)
 
 
+class RegionOfInterestPipeline(CompositePipeline):
+    """
+    Runs a bbox detection pipeline only on a padded window around the
+    position where the object was found in the last frame. The window is moved
+    by the last displacement of the object (constant velocity prediction). If
+    the object is not found in the window, the whole image is searched. The
+    returned bounding box is always in full image coordinates.
+    """
+
+    def __init__(self, detector, padding=ROI_PADDING, min_size=ROI_MIN_SIZE):
+        CompositePipeline.__init__(self, detector)
+
+        self.__padding = padding
+        self.__min_size = min_size
+        self.__last_bbox = None
+        self.__velocity = (0, 0)
+        self.__roi = None
+
+    @property
+    def roi(self):
+        """ The window (x, y, w, h) that was searched last, None for the whole image """
+        return self.__roi
+
+    def reset_roi(self):
+        """ Forgets the last position, so that the next frame is searched completely """
+        self.__last_bbox = None
+        self.__velocity = (0, 0)
+
+    @overrides(CompositePipeline)
+    def reset_state(self):
+        CompositePipeline.reset_state(self)
+        self.reset_roi()
+
+    def __window(self, image_shape):
+        height, width = image_shape[:2]
+        x, y, w, h = self.__last_bbox
+        pad_w = max(w * self.__padding, (self.__min_size - w) / 2)
+        pad_h = max(h * self.__padding, (self.__min_size - h) / 2)
+        x1 = int(max(0, x + self.__velocity[0] - pad_w))
+        y1 = int(max(0, y + self.__velocity[1] - pad_h))
+        x2 = int(min(width, x + self.__velocity[0] + w + pad_w))
+        y2 = int(min(height, y + self.__velocity[1] + h + pad_h))
+        if x2 <= x1 or y2 <= y1:  # predicted out of the image
+            return None
+        return x1, y1, x2 - x1, y2 - y1
+
+    def __found(self, bbox, tracked):
+        # a detection in the whole image may be a jump, not a movement
+        if tracked:
+            self.__velocity = (bbox[0] - self.__last_bbox[0], bbox[1] - self.__last_bbox[1])
+        else:
+            self.__velocity = (0, 0)
+        self.__last_bbox = bbox
+        return True, bbox
+
+    @overrides(CompositePipeline)
+    def _execute(self, inp):
+        """
+        :param inp: an image (np.array)
+        :return: a bounding box in image coordinates (tuple (x, y, w, h) )
+        """
+        detector = self.pipelines[0]
+
+        self.__roi = self.__window(inp.shape) if self.__last_bbox is not None else None
+        if self.__roi is not None:
+            x, y, w, h = self.__roi
+            with detection_reference(inp):
+                bbox = detector.run_pipeline(inp[y:y + h, x:x + w])
+            if detector.success_state:
+                return self.__found((bbox[0] + x, bbox[1] + y, bbox[2], bbox[3]), True)
+
+        # nothing known or lost the object: fall back to the whole image
+        self.__roi = None
+        bbox = detector.run_pipeline(inp)
+        if detector.success_state:
+            return self.__found(tuple(bbox), False)
+        self.reset_roi()
+        return False, None
+
+    def __str__(self):
+        return "[RegionOfInterestPipeline|{}]".format(self.pipelines[0])
+
+
+class DownscaledDetectionPipeline(CompositePipeline):
+    """
+    Runs a bbox detection pipeline on a downscaled copy of the image and maps
+    the bounding box back to full image coordinates. With refine set, the
+    detector is run once more at full resolution on a small window around the
+    mapped bbox to recover the lost precision.
+    """
+
+    def __init__(self, detector, scale=DETECTION_SCALE, refine=DETECTION_REFINE):
+        CompositePipeline.__init__(self, detector)
+
+        self.scale = scale
+        self.refine = refine
+
+    def __refine(self, inp, bbox):
+        detector = self.pipelines[0]
+        height, width = inp.shape[:2]
+        pad = int(np.ceil(2 / self.scale))
+        x1, y1 = max(0, bbox[0] - pad), max(0, bbox[1] - pad)
+        x2, y2 = min(width, bbox[0] + bbox[2] + pad), min(height, bbox[1] + bbox[3] + pad)
+
+        with detection_reference(inp):
+            refined = detector.run_pipeline(inp[y1:y2, x1:x2])
+        if not detector.success_state:
+            return bbox
+        return refined[0] + x1, refined[1] + y1, refined[2], refined[3]
+
+    @overrides(CompositePipeline)
+    def _execute(self, inp):
+        """
+        :param inp: an image (np.array)
+        :return: a bounding box in image coordinates (tuple (x, y, w, h) )
+        """
+        detector = self.pipelines[0]
+        if self.scale == 1:
+            bbox = detector.run_pipeline(inp)
+            return detector.success_state, bbox
+
+        small = cv2.resize(inp, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        with detection_reference(inp, self.scale):
+            bbox = detector.run_pipeline(small)
+        if not detector.success_state:
+            return False, None
+
+        bbox = tuple(int(round(v / self.scale)) for v in bbox)
+        if self.refine:
+            bbox = self.__refine(inp, bbox)
+        return True, bbox
+
+    def __str__(self):
+        return "[DownscaledDetectionPipeline|scale={}: {}]".format(self.scale, self.pipelines[0])
+
+
 class FindYDeviationPipeline(Pipeline):
     """ Finds the deviation of a bounding box on the x-axis"""
 
@@ -277,7 +724,8 @@ class FindYDeviationPipeline(Pipeline):
     @overrides(Pipeline)
     def _execute(self, inp):
         """
-        :param inp: a bounding box and the image coordinates (tuple)
+        :param inp: a bounding box and the image coordinates (tuple, or the
+            namedtuple (contour_bbox, image_shape) of a DAGPipeline node)
         :return: the deviation of the bounding box along the x axis (float in [-1, 1])
         """
         (left_x, _, width, _), (_, image_width, _) = inp
@@ -442,6 +890,12 @@ class KalmanFilterPipeline(Pipeline):
         self.__sensor_noise = sensor_noise
         self.__kalman_gain = 1
 
+    @overrides(Pipeline)
+    def reset_state(self):
+        self.__state = 0
+        self.__error = 1
+        self.__kalman_gain = 1
+
     def _execute(self, inp):
         """
         :param inp: a signal (float)
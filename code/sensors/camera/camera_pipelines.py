@@ -2,6 +2,12 @@ from sensors.camera import camera
 from sensors.pipeline import *
 
 
+def _parallel_pipeline(use_processes):
+    """ Selects the thread or the process backed conjunctive pipeline. Use
+    processes for branches that are dominated by pure python code. """
+    return ConjunctiveProcessPipeline if use_processes else ConjunctiveParallelPipeline
+
+
 def color_filter_pipeline(color="magenta"):
     return \
         PipelineSequence(
@@ -12,17 +18,37 @@ def color_filter_pipeline(color="magenta"):
         )
 
 
-def color_tracking_pipeline(color="magenta"):
+def color_tracking_pipeline(color="magenta", roi=False, scale=DETECTION_SCALE, refine=DETECTION_REFINE,
+                            fused_mask=False):
+    """ With roi set, only a window around the last detection is processed,
+    see camera.RegionOfInterestPipeline. With a scale below 1 the detection
+    runs on a downscaled image, see camera.DownscaledDetectionPipeline. With
+    fused_mask set, the color mask is computed by a single
+    camera.ColorMaskPipeline and there is no hsv_image step. """
+    wrapped = roi or scale != 1
+    if not fused_mask:
+        masking = [("hsv_image", camera.ConvertColorspacePipeline(to='hsv')),
+                   ("threshold", camera.ColorThresholdPipeline(color=color))]
+    else:
+        masking = [("threshold", camera.ColorMaskPipeline(color=color))]
+    detection = \
+        PipelineSequence(
+            *masking,
+            ("filtered", camera.ErodeDilatePipeline()),
+            ("contour_bbox" if not wrapped else "detected_bbox", camera.GetLargestContourPipeline())
+        )
+    if scale != 1:
+        detection = camera.DownscaledDetectionPipeline(detection, scale=scale, refine=refine)
+    if roi:
+        detection = camera.RegionOfInterestPipeline(detection)
+    if wrapped:
+        detection = ("contour_bbox", detection)
+
     return \
         PipelineSequence(
             ("image", camera.READ_CAMERA_PIPELINE),
             ConjunctiveParallelPipeline(
-                PipelineSequence(
-                    ("hsv_image", camera.ConvertColorspacePipeline(to='hsv')),
-                    ("threshold", camera.ColorThresholdPipeline(color=color)),
-                    ("filtered", camera.ErodeDilatePipeline()),
-                    ("contour_bbox", camera.GetLargestContourPipeline())
-                ),
+                detection,
                 camera.GetImageDimensionsPipeline()
             ),
             ("raw_y_deviation", camera.FindYDeviationPipeline()),
@@ -30,14 +56,45 @@ def color_tracking_pipeline(color="magenta"):
         )
 
 
-def fast_color_tracking_pipeline(color="magenta"):
+def color_tracking_dag_pipeline(color="magenta", fused_mask=False):
+    """ The color tracking pipeline as a DAGPipeline. The image dimensions are
+    computed as soon as the image was read, concurrently to the detection. """
+    if not fused_mask:
+        masking = [("hsv_image", camera.ConvertColorspacePipeline(to='hsv'), "image"),
+                   ("threshold", camera.ColorThresholdPipeline(color=color), "hsv_image")]
+    else:
+        masking = [("threshold", camera.ColorMaskPipeline(color=color), "image")]
+
+    return \
+        DAGPipeline(
+            ("image", camera.READ_CAMERA_PIPELINE),
+            *masking,
+            ("filtered", camera.ErodeDilatePipeline(), "threshold"),
+            ("contour_bbox", camera.GetLargestContourPipeline(), "filtered"),
+            ("image_shape", camera.GetImageDimensionsPipeline(), "image"),
+            ("raw_y_deviation", camera.FindYDeviationPipeline(), "contour_bbox", "image_shape"),
+            ("y_deviation", camera.KalmanFilterPipeline(), "raw_y_deviation")
+        )
+
+
+def multi_color_tracking_pipeline(colors=("magenta", "yellow")):
+    """ Finds the bounding boxes of several colors while converting and
+    traversing the image only once """
     return \
         PipelineSequence(
             ("image", camera.READ_CAMERA_PIPELINE),
-            ConjunctiveParallelPipeline(
+            ("hsv_image", camera.ConvertColorspacePipeline(to='hsv')),
+            ("color_labels", camera.MultiColorThresholdPipeline(colors)),
+            ("color_bboxes", camera.MultiColorBBoxPipeline(colors))
+        )
+
+
+def fast_color_tracking_pipeline(color="magenta", use_processes=False):
+    return \
+        PipelineSequence(
+            ("image", camera.READ_CAMERA_PIPELINE),
+            _parallel_pipeline(use_processes)(
                 PipelineSequence(
-                    camera.ConvertColorspacePipeline(to='hsv'),
-                    camera.ColorThresholdPipeline(color),
                     ("contour_bbox", camera.FastColorDetectionPipeline(color)),
                 ),
                 camera.GetImageDimensionsPipeline()
@@ -46,11 +103,11 @@ def fast_color_tracking_pipeline(color="magenta"):
         )
 
 
-def color_tracking_dbscan_pipeline(color="magenta"):
+def color_tracking_dbscan_pipeline(color="magenta", use_processes=False):
     return \
         PipelineSequence(
             ("image", camera.READ_CAMERA_PIPELINE),
-            ConjunctiveParallelPipeline(
+            _parallel_pipeline(use_processes)(
                 PipelineSequence(
                     camera.ConvertColorspacePipeline(to='hsv'),
                     camera.ColorThresholdPipeline(color=color),
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+"""
+Compares the contour based color detection with the FastColorDetectionPipeline
+at CAMERA_RESOLUTION. Run from the code directory:
+
+    python3 -m sensors.camera.tests.benchmark_color_detection [image files]
+
+Without image files, synthetic frames with a magenta rectangle are used.
+"""
+
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from config.config import *
+from sensors.camera import camera
+from sensors.pipeline import PipelineSequence
+
+
+ITERATIONS = 50
+
+
+def synthetic_frames(count=10, seed=0):
+    """ Creates BGR frames with a blotchy background that contain a magenta box at
+    random positions """
+    rng = np.random.RandomState(seed)
+    width, height = CAMERA_RESOLUTION
+    frames = []
+    for _ in range(count):
+        background = rng.randint(0, 160, size=(height // 16, width // 16, 3)).astype(np.uint8)
+        frame = cv2.resize(background, CAMERA_RESOLUTION, interpolation=cv2.INTER_LINEAR)
+        w, h = rng.randint(20, width // 3), rng.randint(20, height // 2)
+        x, y = rng.randint(0, width - w), rng.randint(0, height - h)
+        frame[y:y + h, x:x + w] = (200, 40, 220)
+        frames.append(frame)
+    return frames
+
+
+def load_frames(paths):
+    frames = [cv2.resize(cv2.imread(p), CAMERA_RESOLUTION) for p in paths]
+    return [f for f in frames if f is not None]
+
+
+def benchmark(pipeline, frames):
+    """ Returns the mean time per frame in ms and the results of the first run """
+    results = []
+    for f in frames:
+        out = pipeline.run_pipeline(f)
+        # copy, some pipelines reuse their output buffer
+        results.append((pipeline.success_state, out.copy() if isinstance(out, np.ndarray) else out))
+
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        for f in frames:
+            pipeline.run_pipeline(f)
+    return (time.perf_counter() - start) * 1000 / (ITERATIONS * len(frames)), results
+
+
+def main():
+    frames = load_frames(sys.argv[1:]) if len(sys.argv) > 1 else synthetic_frames()
+
+    contour_path = PipelineSequence(
+        camera.ConvertColorspacePipeline(to='hsv'),
+        camera.ColorThresholdPipeline(color='magenta'),
+        camera.ErodeDilatePipeline(),
+        camera.GetLargestContourPipeline()
+    )
+    fast_path = camera.FastColorDetectionPipeline(color='magenta')
+
+    contour_time, contour_results = benchmark(contour_path, frames)
+    fast_time, fast_results = benchmark(fast_path, frames)
+
+    print("{} frames at {}x{}, {} iterations".format(len(frames), *CAMERA_RESOLUTION, ITERATIONS))
+    print("contour path: {:8.3f}ms/frame".format(contour_time))
+    print("fast path:    {:8.3f}ms/frame ({:.1f}x)".format(fast_time, contour_time / fast_time))
+    for (c_ok, c_bbox), (f_ok, f_bbox) in zip(contour_results, fast_results):
+        print("  contour: {!s:24} fast: {!s:24}".format(c_bbox if c_ok else None, f_bbox if f_ok else None))
+
+    # the color masking step on its own
+    separate = PipelineSequence(
+        camera.ConvertColorspacePipeline(to='hsv'),
+        camera.ColorThresholdPipeline(color='magenta')
+    )
+    separate_time, separate_results = benchmark(separate, frames)
+    print("mask, convert + threshold:  {:8.3f}ms/frame".format(separate_time))
+    mask_time, mask_results = benchmark(camera.ColorMaskPipeline('magenta'), frames)
+    agreement = np.mean([np.mean(a == b) for (_, a), (_, b) in zip(separate_results, mask_results)])
+    print("mask, ColorMaskPipeline:    {:8.3f}ms/frame ({:.1%} equal pixels)".format(mask_time, agreement))
+
+
+if __name__ == "__main__":
+    main()
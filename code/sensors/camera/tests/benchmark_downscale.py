@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+"""
+Reports accuracy versus speedup of the downscaled color detection compared to
+the detection at full resolution. Run from the code directory:
+
+    python3 -m sensors.camera.tests.benchmark_downscale record <dir> [count]
+    python3 -m sensors.camera.tests.benchmark_downscale run [image files]
+
+Without image files, the synthetic frames of benchmark_color_detection are used.
+"""
+
+import argparse
+import os
+import time
+
+import cv2
+
+from config.config import *
+from sensors.camera import camera
+from sensors.camera.tests.benchmark_color_detection import synthetic_frames, load_frames
+from sensors.pipeline import PipelineSequence
+
+
+ITERATIONS = 20
+CONFIGURATIONS = [(1, False), (.5, False), (.5, True), (.25, False), (.25, True)]
+
+
+def detection_pipeline(scale, refine, color="magenta"):
+    return camera.DownscaledDetectionPipeline(
+        PipelineSequence(
+            camera.ConvertColorspacePipeline(to='hsv'),
+            camera.ColorThresholdPipeline(color=color),
+            camera.ErodeDilatePipeline(),
+            camera.GetLargestContourPipeline()
+        ), scale=scale, refine=refine)
+
+
+def iou(a, b):
+    """ Intersection over union of two bounding boxes """
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    intersection = max(0, x2 - x1) * max(0, y2 - y1)
+    union = a[2] * a[3] + b[2] * b[3] - intersection
+    return intersection / union if union > 0 else 0
+
+
+def deviation(bbox, width):
+    return (bbox[0] + bbox[2] / 2 - width / 2) / (width / 2)
+
+
+def record(directory, count):
+    """ Stores count consecutive camera frames in directory """
+    os.makedirs(directory, exist_ok=True)
+    read = camera.READ_CAMERA_PIPELINE
+    read.wait_for_new_frame = True
+    for i in range(count):
+        frame = read.run_pipeline(None)
+        if read.success_state:
+            cv2.imwrite(os.path.join(directory, "frame_{:04d}.png".format(i)), frame)
+
+
+def run(frames):
+    width = frames[0].shape[1]
+    reference = None
+    reference_time = None
+
+    print("{} frames at {}x{}, {} iterations".format(len(frames), width, frames[0].shape[0], ITERATIONS))
+    print("scale  refine    ms/frame  speedup  found   mean iou  mean dev error")
+    for scale, refine in CONFIGURATIONS:
+        pipeline = detection_pipeline(scale, refine)
+
+        results = []
+        for f in frames:
+            bbox = pipeline.run_pipeline(f)
+            results.append(bbox if pipeline.success_state else None)
+
+        start = time.perf_counter()
+        for _ in range(ITERATIONS):
+            for f in frames:
+                pipeline.run_pipeline(f)
+        ms = (time.perf_counter() - start) * 1000 / (ITERATIONS * len(frames))
+
+        if reference is None:
+            reference, reference_time = results, ms
+
+        pairs = [(r, b) for r, b in zip(reference, results) if r is not None and b is not None]
+        mean_iou = sum(iou(r, b) for r, b in pairs) / len(pairs) if pairs else 0
+        mean_dev = sum(abs(deviation(r, width) - deviation(b, width)) for r, b in pairs) / len(pairs) if pairs else 0
+        print("{:5}  {!s:6}  {:10.3f}  {:6.2f}x  {:2}/{:<2}  {:9.3f}  {:14.4f}".format(
+            scale, refine, ms, reference_time / ms, len(pairs), len(frames), mean_iou, mean_dev))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Downscaled color detection benchmark")
+    subparsers = parser.add_subparsers(dest="command")
+    record_parser = subparsers.add_parser("record", help="record camera frames")
+    record_parser.add_argument("directory")
+    record_parser.add_argument("count", type=int, nargs="?", default=100)
+    run_parser = subparsers.add_parser("run", help="run the benchmark")
+    run_parser.add_argument("images", nargs="*")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.directory, args.count)
+    else:
+        images = getattr(args, "images", [])
+        run(load_frames(images) if images else synthetic_frames())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
+import asyncio
 import time  # import the time library for the sleep function
-from collections import deque, namedtuple
-from threading import Thread, Lock
-from utils.functions import current_time_millis, overrides
+from threading import Thread
+from utils.functions import overrides
+from utils.rolling import RollingWindow
+from utils.scheduling import SENSOR_EVENTS
 from sensors.pipeline import Pipeline
 import config
 try:
@@ -12,8 +14,6 @@ except ModuleNotFoundError:
             raspberry pi?). Movement module will not be available.")
     brickpi3 = None
 
-DataTuple = namedtuple("DataTuple", "time distance")
-
 
 class InfraRed:
     def __init__(self):
@@ -30,8 +30,8 @@ class InfraRed:
         self.BP.set_sensor_type(self.BP.PORT_1, self.BP.SENSOR_TYPE.EV3_INFRARED_PROXIMITY)
         self.init_sensor()
 
-        self.lock = Lock()
-        self.data_deque = deque()
+        self.window = RollingWindow(config.IR_DATA_ACC_THRESHOLD)
+        self.notified_distance = None
 
     def accumulate_distance(self):
         """
@@ -40,30 +40,34 @@ class InfraRed:
         """
 
         while True:
-            try:
-                value = self.BP.get_sensor(self.PORT)
-            except brickpi3.SensorError as error:
-                value = None
-            if value:
-                try:
-                    self.lock.acquire()
-                    self.data_deque.append(DataTuple(current_time_millis(), value))
-                finally:
-                    self.lock.release()
-                self.remove_old_data()
-
-    def remove_old_data(self, threshold=config.IR_DATA_ACC_THRESHOLD):
-        """Removes data tuples from the queue that are older
-        than threshold milliseconds"""
+            self.read_sensor()
 
-        threshold = current_time_millis() - threshold
+    async def produce(self, interval=config.IR_SAMPLE_INTERVAL):
+        """
+        accumulate_distance for the asyncio runtime, reads the sensor every
+        interval ms instead of continuously
+        :return:
+        """
+        while True:
+            self.read_sensor()
+            await asyncio.sleep(interval / 1000)
 
+    def read_sensor(self):
+        """
+        reads a single value and stores it
+        :return: -
+        """
         try:
-            self.lock.acquire()
-            while len(self.data_deque) > 0 and self.data_deque[0].time < threshold:
-                self.data_deque.popleft()
-        finally:
-            self.lock.release()
+            value = self.BP.get_sensor(self.PORT)
+        except brickpi3.SensorError as error:
+            value = None
+        if value:
+            self.window.append(value)
+
+            # only changes wake the state machine, the sensor is read continuously
+            if self.notified_distance is None or abs(value - self.notified_distance) >= config.IR_EVENT_DISTANCE:
+                self.notified_distance = value
+                SENSOR_EVENTS.notify("infrared")
 
     def init_sensor(self):
         """
@@ -84,53 +88,21 @@ class InfraRed:
         if_t.start()
 
     def __len__(self):
-        """Returns the amount of data that is present in the queue"""
-        # As old data is only removed when new data is added, we have to
-        # ensure that old data is being deleted before counting the elements
-        # in the queue
-        self.remove_old_data()
-        try:
-            self.lock.acquire()
-            return len(self.data_deque)
-        finally:
-            self.lock.release()
+        """Returns the amount of data that is present in the window"""
+        return len(self.window)
 
     def get_avg_value(self):
         """ Returns the average of the measured data"""
-        try:
-            self.lock.acquire()
-            if len(self.data_deque) == 0:
-                return None
-            return sum(r[1] for r in self.data_deque) / len(self.data_deque)
-        finally:
-            self.lock.release()
+        return self.window.mean()
+
+    def get_stats(self):
+        """ Returns the WindowStats (count, mean, variance) of the measured
+        data, all from the same state of the window"""
+        return self.window.stats()
 
     def check_if_sensor_data_changed(self, time_threshold=config.IR_TIME_THRESHOLD, distance_threshold=config.IR_DISTANCE_THRESHOLD):
         """ Return true if data changed by more than distance threshold in time_threshold"""
-        upper_threshold = current_time_millis() - time_threshold
-        under_threshold = current_time_millis() - time_threshold*2
-        upper_avg = []
-        under_avg = []
-        try:
-            self.lock.acquire()
-            if len(self.data_deque) == 0:
-                return None
-            for i in reversed(self.data_deque):
-                if i.time > upper_threshold:
-                    upper_avg.append(i.distance)
-                if under_threshold < i.time < upper_threshold:
-                    under_avg.append(i.distance)
-        finally:
-            self.lock.release()
-
-        if len(upper_avg) == 0 or len(under_avg) == 0:
-            return False
-        upper_avg = sum(upper_avg) / len(upper_avg)
-        under_avg = sum(under_avg) / len(under_avg)
-
-        if abs(upper_avg - under_avg) > distance_threshold:
-            return True
-        return False
+        return self.window.changed(time_threshold, distance_threshold)
 
 
 class IRGetDistancePipeline(Pipeline):
@@ -142,9 +114,11 @@ class IRGetDistancePipeline(Pipeline):
     @overrides(Pipeline)
     def _execute(self, inp):
         """Takes an UltraSonic object and returns the average value."""
-        if len(inp) == 0:
+        # a single read, len() and the average could see different values
+        stats = inp.get_stats()
+        if stats.count == 0:
             return False, None
-        return True, inp.get_avg_value()
+        return True, stats.mean
 
 
 class IRGetMovementPipeline(Pipeline):
@@ -1,10 +1,147 @@
-from utils.functions import current_time_millis, overrides, get_class_name, deprecated
-from threading import Thread
+from utils.functions import overrides, get_class_name, deprecated, monotonic_ns, millis_to_ns, NS_PER_MS
+from utils.profiling import StageProfile
+from threading import Lock, Condition, Thread
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+from multiprocessing import shared_memory
+import _thread
+import asyncio
+import atexit
 import logging
+import multiprocessing
 import numpy as np
 from config.config import *
 
 
+# The queue wait (time between submitting a branch and a worker picking it up)
+# and the run time of a single branch of a parallel pipeline, both in ms
+BranchTiming = namedtuple("BranchTiming", "queue_time run_time")
+
+# seconds an early exiting pipeline gives the pool to pick up its branches
+# before the calling thread runs them itself
+_STEAL_DELAY = .005
+
+_executor = None
+_executor_lock = Lock()
+
+_tick_deadline = None  # monotonic_ns() at which the budget of the current tick expires
+
+# seconds a new worker process of a process parallel pipeline may take to
+# import its modules and unpickle its branch
+_WORKER_START_TIMEOUT = 60
+
+
+def configure_executor(max_workers=PARALLEL_PIPELINE_WORKERS):
+    """ (Re)creates the thread pool that is shared by all parallel pipelines.
+    Branches that are already running on the old pool are finished there. """
+    global _executor
+
+    with _executor_lock:
+        old_executor = _executor
+        _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline")
+    if old_executor is not None:
+        old_executor.shutdown(wait=False)
+
+
+def get_executor():
+    """ Returns the shared thread pool, creating it on first use """
+    with _executor_lock:
+        executor = _executor
+    if executor is None:
+        configure_executor()
+        executor = _executor
+    return executor
+
+
+def set_tick_budget(budget):
+    """ Starts a tick that may take budget ms (None: unlimited). The budget is
+    split across the stages on the fly: every stage may use what the previous
+    stages left, stages that would start after it expired time out. """
+    global _tick_deadline
+    _tick_deadline = monotonic_ns() + millis_to_ns(budget) if budget is not None else None
+
+
+def remaining_tick_time():
+    """ Returns the ms that are left of the tick budget, or None if there is no budget """
+    deadline = _tick_deadline
+    return (deadline - monotonic_ns()) / NS_PER_MS if deadline is not None else None
+
+
+class MemoCache(object):
+    """
+    Memoizes the results of pure pipeline stages for the duration of one tick.
+    A result is keyed by the memo_key of the stage and by its input, which is
+    either a camera frame (identified by frame id and the viewed region) or the
+    output of another memoized stage. Identical stages that process the same
+    frame, e.g. HSV conversions in different branches, are thus run only once.
+    """
+
+    def __init__(self, max_size=MEMO_CACHE_SIZE):
+        self.enabled = USE_PIPELINE_MEMOIZATION
+        self.hits = 0
+        self.misses = 0
+
+        self.__max_size = max_size
+        self.__lock = Lock()
+        self.__results = {}  # key -> (input, succ, out), the input is kept so that its id stays unique
+        self.__output_keys = {}  # id of a cached output -> key it was computed with
+        self.__owner_keys = {}  # stage -> key of its last cached result
+
+    def clear(self):
+        """ Forgets all results, called at the beginning of every tick """
+        with self.__lock:
+            self.__results.clear()
+            self.__output_keys.clear()
+            self.__owner_keys.clear()
+
+    def key(self, pipeline, inp):
+        """ Returns the key for running pipeline on inp or None if the result can not be memoized """
+        if not self.enabled:
+            return None
+        memo_key = pipeline.memo_key
+        if memo_key is None:
+            return None
+
+        frame_id = getattr(inp, "frame_id", None)
+        if frame_id is not None:
+            input_key = ("frame", frame_id, inp.__array_interface__["data"][0], inp.shape, inp.strides)
+        else:
+            with self.__lock:
+                input_key = self.__output_keys.get(id(inp))
+            if input_key is None:
+                return None
+        return memo_key, input_key
+
+    def get(self, key):
+        """ Returns the cached (succ, out) for key or None """
+        with self.__lock:
+            entry = self.__results.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def put(self, key, pipeline, inp, succ, out):
+        with self.__lock:
+            if len(self.__results) >= self.__max_size:
+                self.__results.clear()
+                self.__output_keys.clear()
+                self.__owner_keys.clear()
+
+            # stages may reuse their output buffers, so the previous result of the stage becomes invalid
+            old_key = self.__owner_keys.get(pipeline)
+            if old_key is not None:
+                old_entry = self.__results.pop(old_key, None)
+                if old_entry is not None:
+                    self.__output_keys.pop(id(old_entry[2]), None)
+
+            self.__results[key] = (inp, succ, out)
+            self.__owner_keys[pipeline] = key
+            if out is not None:
+                self.__output_keys[id(out)] = key
+
+
 class Pipeline(object):
     """ Base object for all pipelines"""
 
@@ -12,13 +149,64 @@ class Pipeline(object):
         self.execute_callbacks = []
         self._debug_prefix = ""
 
+        # ms an execution may take (None: unlimited). An execution that takes
+        # longer keeps running in the background and the stage yields the
+        # last successful output, if keep_last_on_timeout is set, or fails.
+        self.timeout = None
+        self.keep_last_on_timeout = False
+        self.timeouts = 0
+
+        self.profile = StageProfile() if PROFILE_PIPELINES else None
+
         self.__succ = False
         self.__output = None
+        self.__last_good = None
+        self.__pending = None
+
+    def __getstate__(self):
+        # pipelines are pickled to start the workers of process parallel
+        # pipelines, background executions and callbacks stay in this process
+        state = self.__dict__.copy()
+        state["_Pipeline__pending"] = None
+        state["execute_callbacks"] = []
+        return state
 
     def reset_pipeline(self):
         self.__succ = False
         self.__output = None
 
+    def reset_state(self):
+        """ Resets internal state that is kept between executions (e.g. filter
+        values), so that the pipeline behaves as if it was newly created """
+        pass
+
+    def finish_background(self):
+        """ Waits for the executions that still run in the background after a
+        timeout or an early exit (queued ones are cancelled), e.g. before
+        another pipeline uses the same sensors """
+        pending = self.__pending
+        if pending is not None and not pending.cancel():
+            wait([pending])
+
+    async def run_pipeline_async(self, inp):
+        """ Awaitable run_pipeline. The pipeline runs on the default executor
+        of the loop, so that the event loop keeps serving the sensors in the
+        meantime and the shared pool is left to the branches. """
+        return await asyncio.get_running_loop().run_in_executor(None, self.run_pipeline, inp)
+
+    @property
+    def memo_key(self):
+        """ A hashable that identifies the computation of a pure stage, whose
+        output only depends on its input. Stages with equal keys share their
+        results within a tick (see MemoCache). None disables memoization. """
+        return None
+
+    def _set_result(self, succ, out):
+        """ Stores a result that was computed outside of run_pipeline, e.g. in
+        a worker process """
+        self.__succ = succ
+        self.__output = out
+
     @property
     def output(self):
         return self.__output
@@ -42,23 +230,62 @@ class Pipeline(object):
     def run_pipeline(self, inp):
         self.reset_pipeline()
 
-        start = current_time_millis()
-        succ, out = self._execute(inp)
-        exectime = current_time_millis() - start
+        start = monotonic_ns()
+        key = MEMO_CACHE.key(self, inp)
+        cached = MEMO_CACHE.get(key) if key is not None else None
+        if cached is None:
+            result = self.__execute_in_time(inp)
+            if result is None:
+                succ, out = self.__timeout_result()
+            else:
+                succ, out = result
+                if key is not None:
+                    MEMO_CACHE.put(key, self, inp, succ, out)
+                if succ and self.keep_last_on_timeout:
+                    self.__last_good = out
+        else:
+            succ, out = cached
+        end = monotonic_ns()
 
-        start = current_time_millis()
         for cb in self.execute_callbacks:
             cb(inp, out)
-        callbacktime = current_time_millis() - start
 
-        logging.debug(self.debug_prefix + "Executing pipeline {} took {}ms (callbacktime: {}ms)".format(
-            self.__class__.__name__, exectime, callbacktime))
+        if self.profile is not None:
+            self.profile.record(end - start, monotonic_ns() - end)
 
         self.__succ = succ
         self.__output = out
 
         return out
 
+    def __execute_in_time(self, inp):
+        """ Runs _execute within the timeout and the remaining tick budget.
+        Returns None if the time ran out. """
+        remaining = remaining_tick_time()
+        if remaining is not None and remaining <= 0:
+            return None
+        if self.timeout is None:
+            return self._execute(inp)
+
+        if self.__pending is not None:
+            if not self.__pending.done():
+                return None  # do not pile up executions of a stalled stage
+            self.__pending = None
+
+        timeout = self.timeout if remaining is None else min(self.timeout, remaining)
+        future = get_executor().submit(self._execute, inp)
+        try:
+            return future.result(timeout=timeout / 1000)
+        except FutureTimeoutError:
+            self.__pending = future
+            return None
+
+    def __timeout_result(self):
+        self.timeouts += 1
+        if self.keep_last_on_timeout and self.__last_good is not None:
+            return True, self.__last_good
+        return False, None
+
     def _execute(self, inp):
         raise NotImplementedError()
 
@@ -84,7 +311,7 @@ class CompositePipeline(Pipeline):
                 name = p[0]
                 # check type of first element
                 if issubclass(type(p[1]), CompositePipeline):
-                    self.named_pipelines.update(p[1].named_pipeline)
+                    self.named_pipelines.update(p[1].named_pipelines)
                     toappend = p[1]
                 elif issubclass(type(p[1]), Pipeline):
                     toappend = p[1]
@@ -107,6 +334,17 @@ class CompositePipeline(Pipeline):
         for p in self.pipelines:
             p.reset_pipeline()
 
+    @overrides(Pipeline)
+    def reset_state(self):
+        for p in self.pipelines:
+            p.reset_state()
+
+    @overrides(Pipeline)
+    def finish_background(self):
+        Pipeline.finish_background(self)
+        for p in self.pipelines:
+            p.finish_background()
+
     @property
     def debug_prefix(self):
         return self._debug_prefix
@@ -175,34 +413,92 @@ class AbstractParallelPipeline(CompositePipeline):
         CompositePipeline.__init__(self, *pipelines)
 
         self.use_parallel = USE_TRUE_PARALLEL_PIPELINES
+        self._branch_timings = []
+        self._branch_results = []
+        self._background = [None] * len(self.pipelines)  # futures of branches that may still be running
+
+    @overrides(CompositePipeline)
+    def reset_pipeline(self):
+        Pipeline.reset_pipeline(self)
+
+        for p, future in zip(self.pipelines, self._background):
+            if future is None or future.done():  # do not touch branches that are still running
+                p.reset_pipeline()
+
+    @overrides(CompositePipeline)
+    def finish_background(self):
+        running = [f for f in self._background if f is not None and not f.cancel()]
+        wait(running)
+        CompositePipeline.finish_background(self)
+
+    @property
+    def branch_timings(self):
+        """ The BranchTiming of each child pipeline during the last execution """
+        return self._branch_timings
+
+    @property
+    def branch_results(self):
+        """ The (success, output) tuple of each child pipeline that the last
+        execution combined. Use these instead of the results of the children, as
+        branches of an early exiting pipeline may still run in the background. """
+        return self._branch_results
+
+    def _combine(self, results):
+        self._branch_results = results
+        succ = self.combine_success([succ for succ, _ in results])
+        out = self.combine_outputs([out for _, out in results])
+        return succ, out
 
     @overrides(CompositePipeline)
     def _execute(self, inp):
-        return self._execute_parallel(inp) if self.use_parallel else self._execute_parallel(inp)
+        return self._execute_parallel(inp) if self.use_parallel else self._execute_sequential(inp)
 
     def _execute_sequential(self, inp):
-        results = []
+        timings = []
 
         for pipeline in self.pipelines:
-            out = pipeline.run_pipeline(inp)
-            succ = pipeline.success_state
-            results.append((succ, out))
+            start = monotonic_ns()
+            pipeline.run_pipeline(inp)
+            timings.append(BranchTiming(0.0, (monotonic_ns() - start) / NS_PER_MS))
+        self._branch_timings = timings
 
-        out = self.combine_outputs([p.output for p in self.pipelines])
-        succ = self.combine_success([p.success_state for p in self.pipelines])
-        return out, succ
+        return self._combine([p.result for p in self.pipelines])
 
     def _execute_parallel(self, inp):
-        threads = [Thread(target=p.run_pipeline, args=(inp,)) for p in self.pipelines]
-
-        for thread in threads:
-            thread.start()
-        for thread in threads:
-            thread.join()
+        if len(self.pipelines) == 0:
+            return self._execute_sequential(inp)
+
+        executor = get_executor()
+        timings = [None] * len(self.pipelines)
+        submitted = [monotonic_ns()] * len(self.pipelines)
+
+        def run_branch(i):
+            start = monotonic_ns()
+            try:
+                self.pipelines[i].run_pipeline(inp)
+            except Exception:
+                logging.exception("Branch {} of {} failed".format(i, get_class_name(self)))
+            timings[i] = BranchTiming((start - submitted[i]) / NS_PER_MS, (monotonic_ns() - start) / NS_PER_MS)
+
+        # the calling thread runs the first branch itself, all others are
+        # handed to the shared pool
+        futures = []
+        for i in range(1, len(self.pipelines)):
+            submitted[i] = monotonic_ns()
+            futures.append(executor.submit(run_branch, i))
+        run_branch(0)
+
+        for i, future in enumerate(futures, 1):
+            # A branch that no worker has picked up yet is run by the calling
+            # thread. This way nested parallel pipelines can never starve the
+            # pool by waiting on branches that are queued behind themselves.
+            if future.cancel():
+                run_branch(i)
+            else:
+                future.result()
+        self._branch_timings = timings
 
-        out = self.combine_outputs([p.output for p in self.pipelines])
-        succ = self.combine_success([p.success_state for p in self.pipelines])
-        return succ, out
+        return self._combine([p.result for p in self.pipelines])
 
     def combine_outputs(self, outputs):
         raise NotImplementedError()
@@ -241,11 +537,115 @@ class DisjunctiveParallelPipeline(AbstractParallelPipeline):
     The result is a tuple that contains the success flag, which is true, if at
     least one pipelines was successfull. The second component is a tuple
     containing the result tuples of the parallel pipelines.
+
+    Given priorities, a quorum or a deadline (in ms), the pipeline exits early:
+    it returns as soon as all branches with the highest (positive) priority
+    are done, as soon as quorum branches were successful or when the deadline
+    expires. Branches that are not done keep running in the background and are
+    not restarted before they finish. Until then, the pipeline reports the
+    last result that each of them completed.
     """
 
-    def __init__(self, *pipelines):
+    def __init__(self, *pipelines, priorities=None, quorum=None, deadline=None):
         AbstractParallelPipeline.__init__(self, *pipelines)
 
+        self.priorities = list(priorities) if priorities is not None else [0] * len(self.pipelines)
+        self.quorum = quorum
+        self.deadline = deadline
+
+        self.__latest = [(False, None)] * len(self.pipelines)  # last completed result of every branch
+        # reset_state starts a new generation, results of branches that were
+        # started in an older one are dropped
+        self.__generation = 0
+        self.__generations = [0] * len(self.pipelines)  # generation of every background future
+
+    @overrides(AbstractParallelPipeline)
+    def reset_state(self):
+        AbstractParallelPipeline.reset_state(self)
+        self.__generation += 1
+        self.__latest = [(False, None)] * len(self.pipelines)
+
+    @property
+    def early_exit(self):
+        return self.quorum is not None or self.deadline is not None or any(p > 0 for p in self.priorities)
+
+    def __run_branch(self, i, inp, submitted, generation):
+        start = monotonic_ns()
+        try:
+            out = self.pipelines[i].run_pipeline(inp)
+            result = self.pipelines[i].success_state, out
+        except Exception:
+            logging.exception("Branch {} of {} failed".format(i, get_class_name(self)))
+            result = False, None
+        if generation == self.__generation:
+            self.__latest[i] = result
+            self._branch_timings[i] = BranchTiming((start - submitted) / NS_PER_MS, (monotonic_ns() - start) / NS_PER_MS)
+        return result
+
+    def __submit(self, executor, i, inp):
+        self.__generations[i] = self.__generation
+        self._background[i] = executor.submit(self.__run_branch, i, inp, monotonic_ns(), self.__generation)
+
+    def __finished(self, done, successful):
+        if all(done):
+            return True
+        if self.quorum is not None and successful >= self.quorum:
+            return True
+        top = max(self.priorities)
+        return top > 0 and all(d for d, p in zip(done, self.priorities) if p == top)
+
+    @overrides(AbstractParallelPipeline)
+    def _execute_parallel(self, inp):
+        if not self.early_exit or len(self.pipelines) == 0:
+            return AbstractParallelPipeline._execute_parallel(self, inp)
+
+        executor = get_executor()
+        start = monotonic_ns()
+        end = start + millis_to_ns(self.deadline) if self.deadline is not None else None
+        remaining = remaining_tick_time()
+        if remaining is not None:
+            budget_end = start + millis_to_ns(remaining)
+            end = min(end, budget_end) if end is not None else budget_end
+        self._branch_timings = [None] * len(self.pipelines)
+
+        futures = self._background
+        for i in range(len(self.pipelines)):
+            if futures[i] is None or futures[i].done():
+                self.__submit(executor, i, inp)
+
+        while True:
+            for i, future in enumerate(futures):
+                # a branch that was still running from before reset_state is
+                # run again as soon as it finished, its result is stale
+                if future is not None and future.done() and self.__generations[i] != self.__generation:
+                    self.__submit(executor, i, inp)
+            done = [f is None or f.done() for f in futures]
+            successful = sum(1 for d, (succ, _) in zip(done, self.__latest) if d and succ)
+            if self.__finished(done, successful):
+                break
+            timeout = (end - monotonic_ns()) / 1e9 if end is not None else None
+            if timeout is not None and timeout <= 0:
+                break
+
+            pending = sorted((i for i, d in enumerate(done) if not d), key=lambda i: -self.priorities[i])
+            if end is not None:
+                wait([futures[i] for i in pending], timeout=timeout, return_when=FIRST_COMPLETED)
+                continue
+
+            # Without a deadline, a branch that no worker picks up is run by the
+            # calling thread (the most important one first), so that nested
+            # parallel pipelines can not starve the pool
+            finished, _ = wait([futures[i] for i in pending], timeout=_STEAL_DELAY, return_when=FIRST_COMPLETED)
+            if finished or any(futures[i].running() for i in pending):
+                continue
+            for i in pending:
+                if futures[i].cancel():
+                    self.__run_branch(i, inp, start, self.__generation)
+                    futures[i] = None
+                    break
+
+        return self._combine(list(self.__latest))
+
     @overrides(AbstractParallelPipeline)
     def combine_outputs(self, outputs):
         return tuple(outputs)
@@ -259,6 +659,385 @@ class DisjunctiveParallelPipeline(AbstractParallelPipeline):
             len(self.pipelines), '||'.join(str(p) for p in self.pipelines))
 
 
+class DAGPipeline(CompositePipeline):
+    """
+    Runs pipelines as nodes of a directed acyclic graph. Every node is given
+    as a tuple (name, pipeline, *input_names). A node without inputs gets the
+    input of the DAG, a node with one input gets the output of that node and a
+    node with several inputs gets a namedtuple of their outputs, whose fields
+    are the input names. A node is only run if all its inputs were successful.
+    Independent nodes run concurrently on the shared thread pool as soon as
+    their inputs are ready. The output of the DAG is the output of the node
+    named output (the last node by default).
+    """
+
+    def __init__(self, *nodes, output=None):
+        CompositePipeline.__init__(self, *[node[:2] for node in nodes])
+
+        self.use_parallel = USE_TRUE_PARALLEL_PIPELINES
+
+        self.__nodes = {}  # name -> (pipeline, input names, input tuple type)
+        self.__dependents = {}
+        for node in nodes:
+            name, inputs = node[0], tuple(node[2:])
+            if name in self.__nodes:
+                raise ValueError("Duplicate node", name)
+            input_type = None
+            if len(inputs) > 1:
+                if not all(i.isidentifier() for i in inputs):
+                    raise ValueError("Input names of node {} must be identifiers".format(name), inputs)
+                input_type = namedtuple(name.title().replace("_", "") + "Inputs", inputs)
+            self.__nodes[name] = (self.named_pipelines[name], inputs, input_type)
+            self.__dependents[name] = []
+        for name, (_, inputs, _) in self.__nodes.items():
+            for i in inputs:
+                if i not in self.__nodes:
+                    raise ValueError("Unknown input of node {}".format(name), i)
+                self.__dependents[i].append(name)
+
+        self.__order = self.__sort()
+        self.__output = output if output is not None else nodes[-1][0]
+        if self.__output not in self.__nodes:
+            raise ValueError("Unknown output node", self.__output)
+
+    def __sort(self):
+        """ Returns the node names in topological order """
+        missing = {name: len(inputs) for name, (_, inputs, _) in self.__nodes.items()}
+        order = [name for name, count in missing.items() if count == 0]
+        for name in order:
+            for dependent in self.__dependents[name]:
+                missing[dependent] -= 1
+                if missing[dependent] == 0:
+                    order.append(dependent)
+        if len(order) != len(self.__nodes):
+            raise ValueError("The pipeline graph contains a cycle",
+                             [name for name in self.__nodes if name not in order])
+        return order
+
+    def __node_input(self, name, inp):
+        _, inputs, input_type = self.__nodes[name]
+        if len(inputs) == 0:
+            return inp
+        if len(inputs) == 1:
+            return self._results[inputs[0]][1]
+        return input_type(*[self._results[i][1] for i in inputs])
+
+    def __run_node(self, name, inp):
+        pipeline = self.__nodes[name][0]
+        try:
+            out = pipeline.run_pipeline(inp)
+            return pipeline.success_state, out
+        except Exception:
+            logging.exception("Node {} of {} failed".format(name, get_class_name(self)))
+            return False, None
+
+    @overrides(CompositePipeline)
+    def _execute(self, inp):
+        self._results = {}
+        if self.use_parallel:
+            self._execute_parallel(inp)
+        else:
+            for name in self.__order:
+                if all(self._results[i][0] for i in self.__nodes[name][1]):
+                    self._results[name] = self.__run_node(name, self.__node_input(name, inp))
+                else:
+                    self._results[name] = (False, None)
+        return self._results[self.__output]
+
+    def _execute_parallel(self, inp):
+        executor = get_executor()
+        missing = {name: len(inputs) for name, (_, inputs, _) in self.__nodes.items()}
+        ready = [name for name in self.__order if missing[name] == 0]
+        running = {}  # future -> node name
+
+        def finish(name, result):
+            self._results[name] = result
+            for dependent in self.__dependents[name]:
+                missing[dependent] -= 1
+                if missing[dependent] == 0:
+                    if all(self._results[i][0] for i in self.__nodes[dependent][1]):
+                        ready.append(dependent)
+                    else:
+                        finish(dependent, (False, None))
+
+        while ready or running:
+            if ready:
+                # all but one ready node are handed to the pool, the calling
+                # thread runs the remaining one itself
+                for name in ready[1:]:
+                    running[executor.submit(self.__run_node, name, self.__node_input(name, inp))] = name
+                name = ready[0]
+                del ready[:]
+                finish(name, self.__run_node(name, self.__node_input(name, inp)))
+                continue
+
+            # A node that no worker has picked up yet is run by the calling
+            # thread, so that nested parallel pipelines can not starve the pool
+            for future in list(running):
+                if future.cancel():
+                    name = running.pop(future)
+                    finish(name, self.__run_node(name, self.__node_input(name, inp)))
+                    break
+            else:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(running.pop(future), future.result())
+
+    def __str__(self):
+        return "[DAGPipeline|{} nodes: {}]".format(len(self.__order), ', '.join(
+            "{}<-({})".format(name, ','.join(self.__nodes[name][1])) for name in self.__order))
+
+
+def _attach_shared_memory(name):
+    """ Attaches to an existing shared memory block without registering it at
+    the resource tracker, as the block is owned by the parent process """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # python < 3.13 has no track parameter
+        # the workers share the resource tracker of the parent, which already
+        # knows the block, so registering it again does nothing (and
+        # unregistering it would drop the registration of the parent)
+        return shared_memory.SharedMemory(name=name)
+
+
+def _process_branch_main(pipeline, conn):
+    """ Main loop of a worker process that executes a single branch of a
+    process parallel pipeline """
+    shm = None
+    conn.send("ready")
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        if message == "reset":
+            # no answer, the next message is only read once this is done
+            pipeline.reset_state()
+            continue
+
+        start = monotonic_ns()
+        MEMO_CACHE.clear()
+        kind, payload, budget = message
+        # the remaining budget of the current tick is sent with every message
+        set_tick_budget(budget)
+        if kind == "shm":
+            name, shape, dtype = payload
+            if shm is None or shm.name != name:
+                if shm is not None:
+                    shm.close()
+                shm = _attach_shared_memory(name)
+            inp = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            inp.flags.writeable = False
+        else:
+            inp = payload
+
+        try:
+            out = pipeline.run_pipeline(inp)
+            succ = pipeline.success_state
+        except Exception:
+            logging.exception("Process branch {} failed".format(pipeline))
+            succ, out = False, None
+        finally:
+            set_tick_budget(None)
+        named = {name: p.result for name, p in getattr(pipeline, "named_pipelines", {}).items()}
+
+        conn.send((succ, out, named, (monotonic_ns() - start) / NS_PER_MS))
+        del inp, out, named  # release the view on the shared memory
+
+    if shm is not None:
+        shm.close()
+    conn.close()
+
+
+class AbstractProcessParallelPipeline(AbstractParallelPipeline):
+    """
+    Runs every branch in a dedicated worker process instead of a thread, so
+    that pure python stages can use the other cores. Numpy inputs (i.e. camera
+    frames) are copied once into a shared memory block that all workers read
+    from, everything else is pickled.
+
+    The outputs of the branches and of their named sub-pipelines are sent back
+    to the main process, unnamed intermediate results stay in the workers.
+    Stateful stages (e.g. a KalmanFilterPipeline) keep their state, as every
+    branch always runs in the same process, reset_state resets it there.
+
+    The workers are started from a fork server (or spawned), as forking the
+    threaded main process could leave a lock in the child that is held
+    forever. Branches therefore have to be picklable. A branch fails if its
+    worker died or did not answer within PROCESS_BRANCH_TIMEOUT ms, the worker
+    is then restarted on the next execution (with fresh state).
+    """
+
+    def __init__(self, *pipelines):
+        AbstractParallelPipeline.__init__(self, *pipelines)
+
+        self.__workers = None
+        self.__shm = None
+
+    @overrides(AbstractParallelPipeline)
+    def reset_state(self):
+        AbstractParallelPipeline.reset_state(self)
+        self._reset_workers()
+
+    def _reset_workers(self):
+        """ Resets the state of the branches in the worker processes """
+        for i, worker in enumerate(self.__workers or []):
+            if worker is None:
+                continue
+            try:
+                worker[1].send("reset")
+            except OSError:
+                logging.error("Lost the connection to the worker of branch {}".format(self.pipelines[i]))
+                self.__stop_worker(i, worker)
+
+    def __start_worker(self, i):
+        """ Starts the worker of branch i and waits until it is ready.
+        Returns (process, conn) or None if it did not start. """
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+        conn, child_conn = context.Pipe()
+        process = context.Process(target=_process_branch_main, args=(self.pipelines[i], child_conn), daemon=True)
+        try:
+            process.start()
+        except Exception:
+            logging.exception("Could not start the worker of branch {}".format(self.pipelines[i]))
+            return None
+        finally:
+            child_conn.close()
+
+        worker = process, conn
+        if self.__receive(i, worker, monotonic_ns() + int(_WORKER_START_TIMEOUT * 1e9)) != "ready":
+            return None
+        return worker
+
+    def __receive(self, i, worker, deadline):
+        """ Returns the next message of the worker of branch i, or None if the
+        worker died or did not answer before deadline (monotonic_ns) """
+        process, conn = worker
+        try:
+            while True:
+                remaining = (deadline - monotonic_ns()) / 1e9
+                if conn.poll(max(0, min(.1, remaining))):
+                    return conn.recv()
+                if not process.is_alive():
+                    logging.error("Worker of branch {} died with exit code {}".format(
+                        self.pipelines[i], process.exitcode))
+                    break
+                if remaining <= 0:
+                    logging.error("Worker of branch {} did not answer in time".format(self.pipelines[i]))
+                    break
+        except (EOFError, OSError):
+            logging.error("Lost the connection to the worker of branch {}".format(self.pipelines[i]))
+        self.__stop_worker(i, worker)
+        return None
+
+    def __stop_worker(self, i, worker):
+        process, conn = worker
+        process.terminate()
+        process.join(timeout=1)
+        conn.close()
+        self.__workers[i] = None
+
+    def __share_frame(self, frame):
+        """ Copies the frame into the shared memory block and returns the
+        message that tells the workers where to find it """
+        if self.__shm is None or self.__shm.size < frame.nbytes:
+            self.__release_shm()
+            self.__shm = shared_memory.SharedMemory(create=True, size=max(1, frame.nbytes))
+        np.ndarray(frame.shape, dtype=frame.dtype, buffer=self.__shm.buf)[...] = frame
+        return "shm", (self.__shm.name, frame.shape, frame.dtype.str), remaining_tick_time()
+
+    def __release_shm(self):
+        if self.__shm is not None:
+            self.__shm.close()
+            self.__shm.unlink()
+            self.__shm = None
+
+    @overrides(AbstractParallelPipeline)
+    def _execute_parallel(self, inp):
+        if len(self.pipelines) == 0:
+            return self._execute_sequential(inp)
+        if self.__workers is None:
+            self.__workers = [None] * len(self.pipelines)
+            atexit.register(self.close)
+        for i, worker in enumerate(self.__workers):
+            if worker is None:
+                self.__workers[i] = self.__start_worker(i)
+
+        message = self.__share_frame(inp) if isinstance(inp, np.ndarray) else ("obj", inp, remaining_tick_time())
+
+        start = monotonic_ns()
+        for i, worker in enumerate(self.__workers):
+            if worker is None:
+                continue
+            try:
+                worker[1].send(message)
+            except OSError:
+                logging.error("Lost the connection to the worker of branch {}".format(self.pipelines[i]))
+                self.__stop_worker(i, worker)
+
+        deadline = start + millis_to_ns(PROCESS_BRANCH_TIMEOUT)
+        timings = []
+        for i, (pipeline, worker) in enumerate(zip(self.pipelines, self.__workers)):
+            reply = self.__receive(i, worker, deadline) if worker is not None else None
+            if reply is None:
+                pipeline._set_result(False, None)
+                for named_pipeline in getattr(pipeline, "named_pipelines", {}).values():
+                    named_pipeline._set_result(False, None)
+                timings.append(BranchTiming(0, (monotonic_ns() - start) / NS_PER_MS))
+                continue
+            succ, out, named, run_time = reply
+            pipeline._set_result(succ, out)
+            for name, (named_succ, named_out) in named.items():
+                pipeline.named_pipelines[name]._set_result(named_succ, named_out)
+            timings.append(BranchTiming((monotonic_ns() - start) / NS_PER_MS - run_time, run_time))
+        self._branch_timings = timings
+
+        return self._combine([p.result for p in self.pipelines])
+
+    def close(self):
+        """ Stops the worker processes and frees the shared memory """
+        if self.__workers is not None:
+            for process, conn in filter(None, self.__workers):
+                try:
+                    conn.send(None)
+                    conn.close()
+                except OSError:
+                    pass  # worker is already gone
+                process.join(timeout=1)
+            self.__workers = None
+        self.__release_shm()
+
+
+class ConjunctiveProcessPipeline(AbstractProcessParallelPipeline, ConjunctiveParallelPipeline):
+    """ A ConjunctiveParallelPipeline whose branches run in worker processes """
+
+    def __init__(self, *pipelines):
+        AbstractProcessParallelPipeline.__init__(self, *pipelines)
+
+    def __str__(self):
+        return "[ConjunctiveProcessPipeline|{} pipelines: {}]".format(
+            len(self.pipelines), '||'.join(str(p) for p in self.pipelines))
+
+
+class DisjunctiveProcessPipeline(AbstractProcessParallelPipeline, DisjunctiveParallelPipeline):
+    """ A DisjunctiveParallelPipeline whose branches run in worker processes.
+    It always waits for all branches, i.e. it never exits early. """
+
+    def __init__(self, *pipelines):
+        DisjunctiveParallelPipeline.__init__(self, *pipelines)
+        AbstractProcessParallelPipeline.__init__(self, *pipelines)
+
+    @overrides(DisjunctiveParallelPipeline)
+    def reset_state(self):
+        DisjunctiveParallelPipeline.reset_state(self)
+        self._reset_workers()
+
+    def __str__(self):
+        return "[DisjunctiveProcessPipeline|{} pipelines: {}]".format(
+            len(self.pipelines), '||'.join(str(p) for p in self.pipelines))
+
+
 class AtomicFunctionPipeline(Pipeline):
     """ A wrapper class that just executes a given funtion """
 
@@ -294,3 +1073,112 @@ class ConstantPipeline(Pipeline):
         return "[ConstantPipeline|const=" + str(self.__const) + "]"
 
 
+def _copy_arrays(values):
+    return tuple(v.copy() if isinstance(v, np.ndarray) else v for v in values)
+
+
+class CallbackDispatcher(object):
+    """
+    Runs callbacks on a single background thread, so that slow callbacks like
+    cv2.imshow never delay the pipelines. Posts of the same key are coalesced:
+    only the newest pending arguments are kept, older ones are dropped.
+    Keeping all callbacks on one thread also keeps all HighGUI calls there.
+    """
+
+    def __init__(self):
+        self.dropped = 0
+
+        self.__pending = OrderedDict()  # key -> (callback, args)
+        self.__condition = Condition()
+        self.__thread = None
+
+    def post(self, key, callback, args):
+        with self.__condition:
+            if key in self.__pending:
+                self.dropped += 1
+            self.__pending[key] = callback, args
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run, name="callbacks", daemon=True)
+                self.__thread.start()
+            self.__condition.notify()
+
+    def call(self, callback, *args):
+        """ Queues a single call that is never dropped (e.g. creating a window) """
+        self.post(object(), callback, args)
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: len(self.__pending) > 0)
+                _, (callback, args) = self.__pending.popitem(last=False)
+            try:
+                callback(*args)
+            except SystemExit:  # e.g. 'q' pressed in a window, stop the main thread instead
+                _thread.interrupt_main()
+                return
+            except Exception:
+                logging.exception("Callback {} failed".format(callback))
+
+
+class AsyncCallback(object):
+    """
+    An execute callback that hands its call to the CALLBACK_DISPATCHER. As the
+    call happens later, snapshot(inp, out) is called right away and its result
+    tuple is passed to callback instead of (inp, out). By default, inp and out
+    are passed with numpy arrays copied, because frames and stage buffers are
+    reused by the next run.
+    """
+
+    def __init__(self, callback, snapshot=None):
+        self.callback = callback
+        self.__snapshot = snapshot if snapshot is not None else lambda inp, out: _copy_arrays((inp, out))
+
+    def __call__(self, inp, out):
+        if ASYNC_CALLBACKS:
+            CALLBACK_DISPATCHER.post(self, self.callback, self.__snapshot(inp, out))
+        else:
+            self.callback(*self.__snapshot(inp, out))
+
+
+def snapshot_results(pipeline, *names):
+    """ Returns the (success, output) tuples of the named sub-pipelines as dict,
+    with numpy outputs copied """
+    return {name: _copy_arrays(pipeline[name].result) for name in names}
+
+
+def async_result_callback(callback, pipeline, *names):
+    """ Returns an AsyncCallback that calls callback with a snapshot_results
+    dict of the named sub-pipelines of pipeline """
+    return AsyncCallback(callback, lambda *_: (snapshot_results(pipeline, *names),))
+
+
+def call_async(callback, *args):
+    """ Runs callback on the callback thread after all pending callbacks """
+    if ASYNC_CALLBACKS:
+        CALLBACK_DISPATCHER.call(callback, *args)
+    else:
+        callback(*args)
+
+
+def profile_report(pipeline, root_name="total"):
+    """ Returns the ProfileSummary of the pipeline (under root_name) and of all
+    its named sub-pipelines, as dict name -> ProfileSummary """
+    report = {}
+    if pipeline.profile is not None:
+        report[root_name] = pipeline.profile.summary()
+    for name, p in getattr(pipeline, "named_pipelines", {}).items():
+        if p.profile is not None:
+            report[name] = p.profile.summary()
+    return report
+
+
+def reset_profiles(pipeline):
+    """ Clears the profiles of the pipeline and all its sub-pipelines """
+    if pipeline.profile is not None:
+        pipeline.profile.reset()
+    for p in getattr(pipeline, "pipelines", []):
+        reset_profiles(p)
+
+
+MEMO_CACHE = MemoCache()
+CALLBACK_DISPATCHER = CallbackDispatcher()
@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+"""
+Builds the process parallel pipelines, resets them like State.reset() does on
+entering a state and runs them. Checks that the reset reaches the state of the
+branches in the worker processes. Run from the code directory:
+
+    python3 -m sensors.tests.check_process_pipelines
+"""
+
+from sensors.pipeline import ConjunctiveProcessPipeline, DisjunctiveProcessPipeline, ConstantPipeline, Pipeline
+from utils.functions import overrides
+
+
+class CountingPipeline(Pipeline):
+    """ Returns the number of its executions since the last reset """
+
+    def __init__(self):
+        Pipeline.__init__(self)
+        self.count = 0
+
+    @overrides(Pipeline)
+    def reset_state(self):
+        self.count = 0
+
+    @overrides(Pipeline)
+    def _execute(self, inp):
+        self.count += 1
+        return True, self.count
+
+
+def check(pipeline_class):
+    pipeline = pipeline_class(ConstantPipeline(1), CountingPipeline())
+    try:
+        pipeline.reset_state()
+        for expected in ((1, 1), (1, 2)):
+            out = pipeline.run_pipeline(None)
+            assert pipeline.success_state, "{} failed".format(pipeline)
+            assert tuple(out) == expected, "{} returned {}".format(pipeline, out)
+        pipeline.reset_state()
+        out = pipeline.run_pipeline(None)
+        assert tuple(out) == (1, 1), "{} was not reset in its workers, returned {}".format(pipeline, out)
+    finally:
+        pipeline.close()
+    print("{}: ok".format(pipeline_class.__name__))
+
+
+def main():
+    check(ConjunctiveProcessPipeline)
+    check(DisjunctiveProcessPipeline)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,13 @@
 # Bibliotheken einbinden
+import asyncio
 import time
-from collections import deque, namedtuple
-from threading import Thread, Lock
+from threading import Thread
 
 import config
 from sensors.pipeline import Pipeline
-from utils.functions import current_time_millis, overrides
+from utils.functions import overrides, monotonic_ns, millis_since, NS_PER_MS
+from utils.rolling import RollingWindow
+from utils.scheduling import SENSOR_EVENTS, get_sensor_executor
 
 try:
     import RPi.GPIO as GPIO
@@ -14,8 +16,6 @@ except ModuleNotFoundError:
           "raspberry pi?). S module will not be available.")
     GPIO = None
 
-DataTuple = namedtuple("DataTuple", "time distance")
-
 class UltraSonic:
 
 
@@ -33,8 +33,8 @@ class UltraSonic:
         GPIO.setup(config.US_GPIO_TRIGGER, GPIO.OUT)
         GPIO.setup(config.US_GPIO_ECHO, GPIO.IN)
 
-        self.lock = Lock()
-        self.data_deque = deque()
+        self.window = RollingWindow(config.US_DATA_ACC_THRESHOLD)
+        self.notified_distance = None
 
     def accumulate_distance(self):
         """
@@ -43,104 +43,86 @@ class UltraSonic:
         """
 
         while True:
+            self.add_data(self.measure())
 
-            # setze Trigger auf HIGH
-            GPIO.output(config.US_GPIO_TRIGGER, True)
+    async def produce(self, interval=config.US_SAMPLE_INTERVAL):
+        """
+        accumulate_distance for the asyncio runtime: every measurement runs on
+        the sensor pool, the interval ms between two of them are awaited
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            self.add_data(await loop.run_in_executor(get_sensor_executor(), self.measure))
+            await asyncio.sleep(interval / 1000)
 
-            # setze Trigger nach 0.01ms aus LOW
-            time.sleep(0.01)
-            GPIO.output(config.US_GPIO_TRIGGER, False)
+    def measure(self):
+        """
+        sends a trigger pulse and times its echo. Both happen in the same
+        thread, so that the echo can not start before it is timed.
+        :return: the distance in cm
+        """
+        # setze Trigger auf HIGH
+        GPIO.output(config.US_GPIO_TRIGGER, True)
 
-            StartZeit = time.time()
-            StopZeit = time.time()
+        # setze Trigger nach 0.01ms aus LOW
+        time.sleep(0.01)
+        GPIO.output(config.US_GPIO_TRIGGER, False)
 
-            timeout = current_time_millis()
+        return self.measure_echo()
 
-            # speichere Startzeit
-            while GPIO.input(config.US_GPIO_ECHO) == 0 and current_time_millis()-timeout<100:
-                StartZeit = time.time()
+    def measure_echo(self):
+        """
+        waits for the echo of a trigger pulse
+        :return: the distance in cm
+        """
+        StartZeit = monotonic_ns()
+        StopZeit = monotonic_ns()
 
-            timeout = current_time_millis()
+        timeout = monotonic_ns()
 
-            # speichere Ankunftszeit
-            while GPIO.input(config.US_GPIO_ECHO) == 1  and current_time_millis()-timeout<100:
-                StopZeit = time.time()
+        # speichere Startzeit
+        while GPIO.input(config.US_GPIO_ECHO) == 0 and millis_since(timeout)<100:
+            StartZeit = monotonic_ns()
 
-            # Zeit Differenz zwischen Start und Ankunft
-            TimeElapsed = StopZeit - StartZeit
-            # mit der Schallgeschwindigkeit (34300 cm/s) multiplizieren
-            # und durch 2 teilen, da hin und zurueck
-            distance = (TimeElapsed * 34300) / 2
+        timeout = monotonic_ns()
 
-            try:
-                self.lock.acquire()
-                self.data_deque.append(DataTuple(current_time_millis(), max(0.0, min(distance, config.US_MAX_VALUE))))
-            finally:
-                self.lock.release()
-            self.remove_old_data()
+        # speichere Ankunftszeit
+        while GPIO.input(config.US_GPIO_ECHO) == 1  and millis_since(timeout)<100:
+            StopZeit = monotonic_ns()
 
-    def remove_old_data(self, threshold=config.US_DATA_ACC_THRESHOLD):
-        """Removes data tuples from the queue that are older
-        than threshold milliseconds"""
+        # Zeit Differenz zwischen Start und Ankunft (in s)
+        TimeElapsed = (StopZeit - StartZeit) / (1000 * NS_PER_MS)
+        # mit der Schallgeschwindigkeit (34300 cm/s) multiplizieren
+        # und durch 2 teilen, da hin und zurueck
+        return (TimeElapsed * 34300) / 2
 
-        threshold = current_time_millis() - threshold
+    def add_data(self, distance):
+        """Stores a measured distance and removes old data"""
+        distance = max(0.0, min(distance, config.US_MAX_VALUE))
+        self.window.append(distance)
 
-        try:
-            self.lock.acquire()
-            while len(self.data_deque) > 0 and self.data_deque[0].time < threshold:
-                self.data_deque.popleft()
-        finally:
-            self.lock.release()
+        # only changes wake the state machine, the sensor measures continuously
+        if self.notified_distance is None or abs(distance - self.notified_distance) >= config.US_EVENT_DISTANCE:
+            self.notified_distance = distance
+            SENSOR_EVENTS.notify("ultrasonic")
 
     def get_avg_value(self):
         """ Returns the average of the measured data"""
-        try:
-            self.lock.acquire()
-            if len(self.data_deque) == 0:
-                return None
-            return sum(r[1] for r in self.data_deque) / len(self.data_deque)
-        finally:
-            self.lock.release()
+        return self.window.mean()
+
+    def get_stats(self):
+        """ Returns the WindowStats (count, mean, variance) of the measured
+        data, all from the same state of the window"""
+        return self.window.stats()
 
     def check_us_sensor_data_changed(self, time_threshold=config.US_TIME_THRESHOLD, distance_threshold=config.US_DISTANCE_THRESHOLD):
         """ Return true if data changed by more than distance threshold in time_threshold"""
-        upper_threshold = current_time_millis() - time_threshold
-        under_threshold = current_time_millis() - time_threshold*2
-        upper_avg = []
-        under_avg = []
-
-        try:
-            self.lock.acquire()
-            if len(self.data_deque) == 0:
-                return None
-            for i in reversed(self.data_deque):
-                if i.time > upper_threshold:
-                    upper_avg.append(i.distance)
-                if under_threshold < i.time < upper_threshold:
-                    under_avg.append(i.distance)
-        finally:
-            self.lock.release()
-
-        if len(upper_avg) == 0 or len(under_avg) == 0:
-            return False
-        upper_avg = sum(upper_avg) / len(upper_avg)
-        under_avg = sum(under_avg) / len(under_avg)
-
-        if abs(upper_avg - under_avg) > distance_threshold:
-            return True
-        return False
+        return self.window.changed(time_threshold, distance_threshold)
 
     def __len__(self):
-        """Returns the amount of data that is present in the queue"""
-        # As old data is only removed when new data is added, we have to
-        # ensure that old data is being deleted before counting the elements
-        # in the queue
-        self.remove_old_data()
-        try:
-            self.lock.acquire()
-            return len(self.data_deque)
-        finally:
-            self.lock.release()
+        """Returns the amount of data that is present in the window"""
+        return len(self.window)
 
     def clean_up(self):
         GPIO.cleanup()
@@ -159,9 +141,11 @@ class USGetDistancePipeline(Pipeline):
     @overrides(Pipeline)
     def _execute(self, inp):
         """Takes an UltraSonic object and returns the average value."""
-        if len(inp) == 0:
+        # a single read, len() and the average could see different values
+        stats = inp.get_stats()
+        if stats.count == 0:
             return False, None
-        return True, inp.get_avg_value()
+        return True, stats.mean
 
 
 class USGetMovementPipeline(Pipeline):
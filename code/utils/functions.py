@@ -3,11 +3,32 @@ import warnings
 import functools
 
 
+NS_PER_MS = 1000000
+
+
 def current_time_millis():
     """ Returns the current system time in milliseconds """
     return int(round(time.time() * 1000))
 
 
+def monotonic_ns():
+    """ Returns the time of a monotonic clock in nanoseconds. Unlike the
+    system time it never jumps (e.g. when ntp sets the clock), but only
+    differences of its values are meaningful. Sensor buffers and pipeline
+    timers use it. """
+    return time.monotonic_ns()
+
+
+def millis_to_ns(ms):
+    """ Converts a duration in ms (as used in the config) to ns """
+    return int(ms * NS_PER_MS)
+
+
+def millis_since(start):
+    """ Returns the ms that passed since the monotonic_ns() time start """
+    return (time.monotonic_ns() - start) / NS_PER_MS
+
+
 def overrides(interface_class):
     """ This method can be used as an @override annotation.
     Inspired by http://stackoverflow.com/questions/1167617/in-python-how-do-i-indicate-im-overriding-a-method
@@ -29,14 +50,20 @@ def deprecated(func):
     """This is a decorator which can be used to mark functions as deprecated. It will result in a warning being emmitted
     when the function is used."""
 
-    @functools.wraps(func)
+    target = func.__init__ if isinstance(func, type) else func
+
+    @functools.wraps(target)
     def new_func(*args, **kwargs):
         warnings.simplefilter('always', DeprecationWarning)
         warnings.warn("Call to deprecated function {}.".format(func.__name__),
                       category=DeprecationWarning, stacklevel=2)
         warnings.simplefilter('default', DeprecationWarning)
-        return func(*args, **kwargs)
+        return target(*args, **kwargs)
 
+    if isinstance(func, type):
+        # wrap the constructor, so that the class itself stays picklable
+        func.__init__ = new_func
+        return func
     return new_func
 
 
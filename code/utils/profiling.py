@@ -0,0 +1,107 @@
+import csv
+from collections import namedtuple
+
+
+# Durations are in ms, callback_mean is the mean time of the execute callbacks
+ProfileSummary = namedtuple("ProfileSummary", "count mean p50 p95 p99 max callback_mean")
+
+_SUB_BITS = 3  # every power of two is split into 2 ** _SUB_BITS buckets
+_SUB_BUCKETS = 1 << _SUB_BITS
+
+
+def _bucket(ns):
+    """ Index of the log-linear histogram bucket of a duration in ns """
+    bits = ns.bit_length()
+    if bits <= _SUB_BITS:
+        return ns
+    return ((bits - _SUB_BITS) << _SUB_BITS) + ((ns >> (bits - _SUB_BITS - 1)) & (_SUB_BUCKETS - 1))
+
+
+def _bucket_limit(index):
+    """ The largest duration in ns that falls into the bucket """
+    if index < _SUB_BUCKETS:
+        return index
+    shift = (index >> _SUB_BITS) - 1
+    return (((index & (_SUB_BUCKETS - 1)) | _SUB_BUCKETS) + 1 << shift) - 1
+
+
+class Histogram(object):
+    """
+    A log-linear histogram of durations in ns with a relative error of at most
+    1 / 2 ** _SUB_BITS. Recording only increments a counter, so it can be used
+    on the hot path.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.__buckets = [0] * (64 << _SUB_BITS)
+
+    def record(self, ns):
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+        self.__buckets[_bucket(ns)] += 1
+
+    def percentile(self, p):
+        """ Returns the duration in ns below which p percent of the records lie """
+        if self.count == 0:
+            return 0
+        rank = p / 100 * self.count
+        seen = 0
+        for index, n in enumerate(self.__buckets):
+            seen += n
+            if n > 0 and seen >= rank:
+                return min(_bucket_limit(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.__buckets = [0] * (64 << _SUB_BITS)
+
+
+class StageProfile(object):
+    """ Execution and callback times of a pipeline stage """
+
+    def __init__(self):
+        self.execution = Histogram()
+        self.callbacks = Histogram()
+
+    def record(self, execution_ns, callback_ns):
+        self.execution.record(execution_ns)
+        self.callbacks.record(callback_ns)
+
+    def summary(self):
+        e = self.execution
+        return ProfileSummary(e.count, e.mean() / 1e6, e.percentile(50) / 1e6, e.percentile(95) / 1e6,
+                              e.percentile(99) / 1e6, e.max / 1e6, self.callbacks.mean() / 1e6)
+
+    def reset(self):
+        self.execution.reset()
+        self.callbacks.reset()
+
+
+def format_report(report):
+    """ Formats a dict name -> ProfileSummary as a table """
+    lines = ["{:24} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+        "stage", "count", "mean ms", "p50 ms", "p95 ms", "p99 ms", "max ms", "cb ms")]
+    for name, s in report.items():
+        lines.append("{:24} {:7d} {:9.3f} {:9.3f} {:9.3f} {:9.3f} {:9.3f} {:9.3f}".format(
+            name, s.count, s.mean, s.p50, s.p95, s.p99, s.max, s.callback_mean))
+    return "\n".join(lines)
+
+
+def write_report(report, path):
+    """ Exports a dict name -> ProfileSummary as csv file """
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(("stage",) + ProfileSummary._fields)
+        for name, s in report.items():
+            writer.writerow((name,) + tuple(s))
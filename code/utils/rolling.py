@@ -0,0 +1,203 @@
+import logging
+import time
+from collections import namedtuple
+from threading import Lock
+
+import numpy as np
+
+from utils.functions import monotonic_ns, millis_to_ns
+
+
+WindowStats = namedtuple("WindowStats", "count mean variance")
+
+# Copies of the times and values of a window (oldest first) and their stats
+WindowSnapshot = namedtuple("WindowSnapshot", "times values stats")
+
+EMPTY_STATS = WindowStats(0, None, None)
+
+
+class RollingWindow(object):
+    """
+    The values of a sensor of the last window ms with their mean and
+    variance. Times are monotonic_ns() times, the window ending at now holds
+    the values with now - window <= time, and ranges (since, until) hold the
+    values with since <= time < until. Values are stored in a ring of
+    (time, value) pairs and the statistics are updated in O(1) when a value is
+    added or expires (Welford's algorithm). The ring is written twice, at i
+    and at i + capacity, so that every window is a contiguous slice.
+
+    A full ring doubles its capacity, so that a sensor that produces more
+    values per window than expected does not lose any of them. Only at
+    max_capacity the oldest values are dropped before they left the window.
+
+    Writers are serialized by a lock, readers never take it. They read a
+    sequence number that is odd while a write is in progress, and retry if
+    it changed while they were reading (a seqlock).
+    """
+
+    def __init__(self, window, capacity=1024, max_capacity=65536):
+        self.window = window
+        self.__window_ns = millis_to_ns(window)
+        self.capacity = capacity
+        self.max_capacity = max(capacity, max_capacity)
+        self.evicted = 0  # values that were dropped while still in the window
+        self.__times = np.zeros(2 * capacity, dtype=np.int64)
+        self.__values = np.zeros(2 * capacity, dtype=np.float64)
+        self.__start = 0  # ring index of the oldest value
+        self.__count = 0
+        self.__mean = 0.0
+        self.__m2 = 0.0
+        self.__seq = 0
+        self.__lock = Lock()
+
+    def append(self, value, now=None):
+        """ Adds a value and expires the values that left the window """
+        now = monotonic_ns() if now is None else now
+        with self.__lock:
+            self.__seq += 1
+            self.__expire(now - self.__window_ns)
+            if self.__count == self.capacity:
+                self.__make_room()
+            index = (self.__start + self.__count) % self.capacity
+            self.__times[index] = self.__times[index + self.capacity] = now
+            self.__values[index] = self.__values[index + self.capacity] = value
+            self.__count += 1
+            delta = value - self.__mean
+            self.__mean += delta / self.__count
+            self.__m2 += delta * (value - self.__mean)
+            if index == self.capacity - 1:
+                # once per pass over the ring the rounding errors of the
+                # incremental updates are discarded
+                self.__recompute()
+            self.__seq += 1
+
+    def expire(self, now=None):
+        """ Removes the values that are older than the window """
+        now = monotonic_ns() if now is None else now
+        with self.__lock:
+            self.__seq += 1
+            self.__expire(now - self.__window_ns)
+            self.__seq += 1
+
+    def __expire(self, threshold):
+        while self.__count > 0 and self.__times[self.__start] < threshold:
+            self.__remove_oldest()
+
+    def __make_room(self):
+        """ Grows the full ring or, at max_capacity, drops the oldest value """
+        if self.capacity < self.max_capacity:
+            capacity = min(2 * self.capacity, self.max_capacity)
+            times = np.zeros(2 * capacity, dtype=np.int64)
+            values = np.zeros(2 * capacity, dtype=np.float64)
+            end = self.__start + self.__count
+            times[:self.__count] = times[capacity:capacity + self.__count] = self.__times[self.__start:end]
+            values[:self.__count] = values[capacity:capacity + self.__count] = self.__values[self.__start:end]
+            self.__times, self.__values = times, values
+            self.__start = 0
+            self.capacity = capacity
+            return
+
+        if self.evicted == 0:
+            logging.warning("More than {} values in a window of {}ms, dropping values that are still in the window"
+                            .format(self.capacity, self.window))
+        self.evicted += 1
+        self.__remove_oldest()
+
+    def __remove_oldest(self):
+        value = self.__values[self.__start]
+        self.__start = (self.__start + 1) % self.capacity
+        self.__count -= 1
+        if self.__count == 0:
+            self.__mean = self.__m2 = 0.0
+            return
+        delta = value - self.__mean
+        self.__mean -= delta / self.__count
+        self.__m2 = max(0.0, self.__m2 - delta * (value - self.__mean))
+
+    def __recompute(self):
+        values = self.__values[self.__start:self.__start + self.__count]
+        self.__mean = float(values.mean()) if self.__count > 0 else 0.0
+        self.__m2 = float(((values - self.__mean) ** 2).sum()) if self.__count > 0 else 0.0
+
+    def __read(self, reader):
+        """ Calls reader without the lock until no write interfered """
+        while True:
+            seq = self.__seq
+            if seq & 1:
+                time.sleep(0)  # let the writer finish
+                continue
+            result = reader(self.__start, self.__count)
+            if self.__seq == seq:
+                return result
+
+    def __slice(self, start, count, since, until=None):
+        """ Bounds of the values with since <= time < until in the ring """
+        times = self.__times[start:start + count]
+        lo = int(np.searchsorted(times, since, side="left"))
+        hi = count if until is None else int(np.searchsorted(times, until, side="left"))
+        return start + lo, start + max(lo, hi)
+
+    def stats(self, now=None):
+        """ Returns the WindowStats of the values in the window that ends at now """
+        threshold = (monotonic_ns() if now is None else now) - self.__window_ns
+
+        def reader(start, count):
+            if count == 0:
+                return EMPTY_STATS
+            if self.__times[start] >= threshold:
+                # nothing expired since the last write
+                return WindowStats(count, self.__mean, self.__m2 / count)
+            return array_stats(self.__values[slice(*self.__slice(start, count, threshold))])
+
+        return self.__read(reader)
+
+    def stats_between(self, since, until=None):
+        """ Returns the WindowStats of the values with since <= time < until """
+        return self.__read(lambda start, count: array_stats(self.__values[slice(*self.__slice(start, count, since, until))]))
+
+    def snapshot(self, since=None):
+        """ Returns a WindowSnapshot of the values in the window (or newer
+        than since) """
+        since = monotonic_ns() - self.__window_ns if since is None else since
+
+        def reader(start, count):
+            lo, hi = self.__slice(start, count, since)
+            values = self.__values[lo:hi]
+            if lo == start and hi > lo:
+                stats = WindowStats(count, self.__mean, self.__m2 / count)
+            else:
+                stats = array_stats(values)
+            return WindowSnapshot(self.__times[lo:hi].copy(), values.copy(), stats)
+
+        return self.__read(reader)
+
+    def changed(self, period, threshold, now=None):
+        """ Returns whether the mean of the last period ms differs by more
+        than threshold from the mean of the period before, None if there is
+        no data at all """
+        now = monotonic_ns() if now is None else now
+        if self.stats(now).count == 0:
+            return None
+        period = millis_to_ns(period)
+        newer = self.stats_between(now - period)
+        older = self.stats_between(now - 2 * period, now - period)
+        if newer.count == 0 or older.count == 0:
+            return False
+        return abs(newer.mean - older.mean) > threshold
+
+    def mean(self, now=None):
+        return self.stats(now).mean
+
+    def variance(self, now=None):
+        return self.stats(now).variance
+
+    def __len__(self):
+        return self.stats().count
+
+
+def array_stats(values):
+    """ Returns the WindowStats of an array of values """
+    if len(values) == 0:
+        return EMPTY_STATS
+    mean = float(values.mean())
+    return WindowStats(len(values), mean, float(((values - mean) ** 2).mean()))
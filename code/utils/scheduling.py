@@ -0,0 +1,178 @@
+import asyncio
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock
+
+import config
+from utils.functions import monotonic_ns
+from utils.profiling import Histogram
+
+
+# rate is in ticks per second, the jitter in ms and idle in percent of the wall time
+TickStats = namedtuple("TickStats", "ticks data_ticks rate jitter_p50 jitter_p95 jitter_max idle")
+
+_sensor_executor = None
+_sensor_executor_lock = Lock()
+
+
+def get_sensor_executor():
+    """ Returns the thread pool for the blocking sensor reads of the asyncio
+    runtime, creating it on first use. It is separate from the pipeline pool,
+    so that the branches of a tick never queue behind a camera capture. """
+    global _sensor_executor
+
+    with _sensor_executor_lock:
+        if _sensor_executor is None:
+            _sensor_executor = ThreadPoolExecutor(max_workers=config.SENSOR_IO_WORKERS, thread_name_prefix="sensor")
+        return _sensor_executor
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(True)
+
+
+class SensorEvents(object):
+    """
+    Counts the arrival of new sensor data. Sensors call notify from their
+    threads (or coroutines), the state machine waits until the version
+    moved past the one it has last processed.
+    """
+
+    def __init__(self):
+        self.__condition = Condition()
+        self.__version = 0
+        self.__last_time = 0
+        self.__counts = {}
+        self.__waiters = []
+
+    @property
+    def version(self):
+        return self.__version
+
+    @property
+    def last_time(self):
+        """ monotonic_ns() time of the newest notification """
+        return self.__last_time
+
+    @property
+    def counts(self):
+        """ Number of notifications per source """
+        return dict(self.__counts)
+
+    def notify(self, source):
+        with self.__condition:
+            self.__version += 1
+            self.__last_time = monotonic_ns()
+            self.__counts[source] = self.__counts.get(source, 0) + 1
+            self.__condition.notify_all()
+            waiters, self.__waiters = self.__waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    def wait(self, version, timeout=None):
+        """ Blocks until there is data newer than version or timeout seconds
+        passed. Returns whether new data arrived. """
+        with self.__condition:
+            return self.__condition.wait_for(lambda: self.__version > version, timeout)
+
+    async def wait_async(self, version, timeout=None):
+        """ wait for the event loop """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.__condition:
+            if self.__version > version:
+                return True
+            self.__waiters.append((loop, future))
+        try:
+            await asyncio.wait([future], timeout=timeout)
+        finally:
+            with self.__condition:
+                if (loop, future) in self.__waiters:
+                    self.__waiters.remove((loop, future))
+        return future.done()
+
+
+class TickScheduler(object):
+    """
+    Decides when the state machine ticks next. With a rate the ticks are
+    paced to that many per second, with on_data a tick waits for new sensor
+    data. If both are given, the state machine ticks on new data but at
+    least at the rate, so that timeouts of the states still expire. Without
+    either it runs freely as fast as it can.
+    """
+
+    def __init__(self, rate=config.TICK_RATE, on_data=config.TICK_ON_SENSOR_DATA, events=None):
+        self.period = int(1e9 / rate) if rate else None  # ns
+        self.on_data = on_data
+        self.events = events if events is not None else SENSOR_EVENTS
+        self.__next = None
+        self.__version = None  # the first tick does not wait
+        self.reset_stats()
+
+    def __deadline(self, now):
+        if self.period is None:
+            return None
+        return now if self.__next is None else max(self.__next, now)
+
+    def wait(self):
+        """ Blocks until the next tick is due """
+        start = monotonic_ns()
+        deadline = self.__deadline(start)
+        woke = False
+        if self.on_data and self.__version is not None:
+            woke = self.events.wait(self.__version, None if deadline is None else (deadline - start) / 1e9)
+        elif deadline is not None and deadline > start:
+            time.sleep((deadline - start) / 1e9)
+        self.__tick(start, deadline, woke)
+
+    async def wait_async(self):
+        """ wait for the event loop """
+        start = monotonic_ns()
+        deadline = self.__deadline(start)
+        woke = False
+        if self.on_data and self.__version is not None:
+            woke = await self.events.wait_async(self.__version, None if deadline is None else (deadline - start) / 1e9)
+        elif deadline is not None:
+            # sleep(0) still gives the producers a chance to run
+            await asyncio.sleep(max(0, deadline - start) / 1e9)
+        self.__tick(start, deadline, woke)
+
+    def __tick(self, start, deadline, woke):
+        now = monotonic_ns()
+        self.__version = self.events.version
+        if self.__first is None:
+            self.__first = start
+        self.__idle += now - start
+        self.__ticks += 1
+        if woke:
+            self.__data_ticks += 1
+            self.__jitter.record(now - max(start, self.events.last_time))
+        elif deadline is not None:
+            self.__jitter.record(now - deadline)
+        if self.period is not None:
+            self.__next = (now if woke else deadline) + self.period
+
+    def stats(self):
+        """ Returns the TickStats since the last reset """
+        elapsed = monotonic_ns() - self.__first if self.__first is not None else 0
+        j = self.__jitter
+        return TickStats(self.__ticks, self.__data_ticks, self.__ticks * 1e9 / elapsed if elapsed > 0 else 0,
+                         j.percentile(50) / 1e6, j.percentile(95) / 1e6, j.max / 1e6,
+                         100 * self.__idle / elapsed if elapsed > 0 else 0)
+
+    def reset_stats(self):
+        self.__first = None
+        self.__idle = 0
+        self.__ticks = 0
+        self.__data_ticks = 0
+        self.__jitter = Histogram()
+
+
+def format_stats(stats):
+    return "{} ticks ({} on new data), {:.1f}/s, jitter p50 {:.3f}ms p95 {:.3f}ms max {:.3f}ms, {:.1f}% idle".format(
+        *stats)
+
+
+SENSOR_EVENTS = SensorEvents()